@@ -70,6 +70,7 @@ LrTasks.startAsyncTask(
     --delay loading most modules until after data structure refreshed
     local ActionSeries    = require 'ActionSeries'
     local CU              = require 'ClientUtilities'
+    local ControlIds      = require 'ControlIds'
     local DebugInfo       = require 'DebugInfo'
     local Info            = require 'Info'
     local Keys            = require 'Keys'
@@ -92,6 +93,9 @@ LrTasks.startAsyncTask(
     local LastParam           = ''
     local UpdateParamPickup, UpdateParamNoPickup, UpdateParam
     local sendIsConnected = false --tell whether send socket is up or not
+    local Compact = false --TangentBridge and we have agreed to send values by control id (see SendValue)
+    local Tracking = nil --parameter TangentBridge has told us is being turned (see StartTracking)
+    local PhotoNotices = false --TangentBridge wants to know when we move to another photo (see AdjustmentChangeObserver)
     --local constants--may edit these to change program behaviors
     local BUTTON_ON        = 0.40 -- sending 1.0, but use > BUTTON_ON because of note keypressess not hitting 100%
     local PICKUP_THRESHOLD = 0.03 -- roughly equivalent to 4/127
@@ -569,6 +573,15 @@ LrTasks.startAsyncTask(
       ChangedToDirectory = function(value) Profiles.setDirectory(value) end,
       ChangedToFile      = function(value) Profiles.setFile(value) end,
       ChangedToFullPath  = function(value) Profiles.setFullPath(value) end,
+      Protocol           = function(offer) -- TangentBridge offering its extensions, each version adding to the last:
+        -- 1 = GetValues, 2 = compact encoding, 3 = StartTracking/StopTracking, 4 = PhotoChanged
+        -- "N text" offers version N without the compact encoding
+        local version, encoding = offer:match('^(%d+)%s*(%a*)')
+        version = math.min(tonumber(version), 4)
+        Compact = version >= 2 and encoding ~= 'text'
+        PhotoNotices = version >= 4
+        MIDI2LR.SERVER:send('Protocol '..version..'\n')
+      end,
       Pickup             = function(enabled)
         if tonumber(enabled) == 1 then -- state machine
           UpdateParam = UpdateParamPickup
@@ -586,6 +599,25 @@ LrTasks.startAsyncTask(
       Will need to add code to AdjustmentChangeObserver and FullRefresh, and remember last fader
       position received by SetRating.
       --]]
+      StepPhotos         = function(value) -- TangentBridge: move several photos at once, forwards or (if negative) back
+        local n = tonumber(value)
+        local step = n < 0 and LrSelection.previousPhoto or LrSelection.nextPhoto
+        for _ = 1, math.abs(n) do
+          step()
+        end
+      end,
+      StartTracking      = function(param) -- TangentBridge: a dial has started turning; its changes make one history step
+        if Database.Parameters[param] then
+          Tracking = param
+          CU.execFOM(LrDevelopController.startTracking, param)
+        end
+      end,
+      StopTracking       = function(param) -- TangentBridge: the dial has stopped
+        if param == Tracking then
+          Tracking = nil
+          CU.execFOM(LrDevelopController.stopTracking)
+        end
+      end,
       SetRating          = function(value) 
         local newrating = math.min(5,math.floor(tonumber(value)*6))
         if (newrating ~= LrSelection.getRating()) then
@@ -675,11 +707,29 @@ LrTasks.startAsyncTask(
         local LrShell             = import 'LrShell'
         local LrSocket            = import 'LrSocket'
         local CurrentObserver
+        --compact encoding: '#', value (0..1) as six hex digits scaled to 0xffffff, then control id in hex
+        local function SendValue(param, value)
+          local id = Compact and ControlIds.byName[param]
+          if id then
+            local v = math.floor(math.min(math.max(value, 0), 1) * 0xffffff + 0.5)
+            MIDI2LR.SERVER:send(string.format('#%06x%x\n', v, id))
+          else
+            MIDI2LR.SERVER:send(string.format('%s %g\n', param, value))
+          end
+        end
         --call following within guard for reading
         local function AdjustmentChangeObserver()
           local lastrefresh = 0 --will be set to os.clock + increment to rate limit
+          local lastphoto = nil
           return function(observer) -- closure
             if not sendIsConnected then return end -- can't send
+            if PhotoNotices then
+              local photo = LrApplication.activeCatalog():getTargetPhoto()
+              if photo ~= lastphoto then
+                lastphoto = photo
+                MIDI2LR.SERVER:send('PhotoChanged 1\n')
+              end
+            end
             if Limits.LimitsCanBeSet() and lastrefresh < os.clock() then
               -- refresh crop values
               local val = LrDevelopController.getValue("CropBottom")
@@ -696,7 +746,7 @@ LrTasks.startAsyncTask(
               for param in pairs(Database.Parameters) do
                 local lrvalue = LrDevelopController.getValue(param)
                 if observer[param] ~= lrvalue and type(lrvalue) == 'number' then --testing for MIDI2LR.SERVER.send kills responsiveness
-                  MIDI2LR.SERVER:send(string.format('%s %g\n', param, CU.LRValueToMIDIValue(param)))
+                  SendValue(param, CU.LRValueToMIDIValue(param))
                   observer[param] = lrvalue
                   LastParam = param
                 end
@@ -808,9 +858,16 @@ LrTasks.startAsyncTask(
           mode = 'receive',
           onMessage = function(_, message) --message processor
             if type(message) == 'string' then
-              local split = message:find(' ',1,true)
-              local param = message:sub(1,split-1)
-              local value = message:sub(split+1)
+              local param, value
+              if message:sub(1,1) == '#' then -- compact encoding
+                param = ControlIds.byId[tonumber(message:sub(8),16)]
+                value = tonumber(message:sub(2,7),16) / 0xffffff
+                if not param then return end
+              else
+                local split = message:find(' ',1,true)
+                param = message:sub(1,split-1)
+                value = message:sub(split+1)
+              end
               logger:trace('<<< '..param)
               if Database.Parameters[param] then
                 UpdateParam(param,tonumber(value))
@@ -842,12 +899,19 @@ LrTasks.startAsyncTask(
                 --logger:trace('GetValue '..value)
                 --logger:trace('GetValue '..value..' = '..lrvalue)
                 --logger:trace('cooked value is '..CU.LRValueToMIDIValue(value))
-                MIDI2LR.SERVER:send(string.format('%s %g\n', value, CU.LRValueToMIDIValue(value)))
+                SendValue(value, CU.LRValueToMIDIValue(value))
                 observer[param] = lrvalue
+              elseif param == 'GetValues' then -- batched GetValue, names separated by spaces
+                for name in value:gmatch('%S+') do
+                  SendValue(name, CU.LRValueToMIDIValue(name))
+                end
               end
             end
           end,
           onClosed = function( socket )
+            Compact = false -- until TangentBridge offers it again
+            Tracking = nil
+            PhotoNotices = false
             if MIDI2LR.RUNNING then
               logger:trace('client closed, reconnecting')
               -- MIDI2LR closed connection, allow for reconnection
@@ -0,0 +1,123 @@
+--[[----------------------------------------------------------------------------
+ControlIds.lua
+Tangent control ids for MIDI2LR names, used by the compact protocol with TangentBridge.
+Generated by TangentMappingDefinitions.py; do not edit.
+------------------------------------------------------------------------------]]
+local byId = {
+  [0x100] = 'Undo',
+  [0x101] = 'Redo',
+  [0x102] = 'Prev',
+  [0x103] = 'Next',
+  [0x104] = 'ShowClipping',
+  [0x105] = 'VirtualCopy',
+  [0x110] = 'AutoTone',
+  [0x111] = 'WhiteBalanceAuto',
+  [0x120] = 'straightenAngle',
+  [0x121] = 'CropBottom',
+  [0x122] = 'CropLeft',
+  [0x123] = 'CropRight',
+  [0x124] = 'CropTop',
+  [0x125] = 'ResetCrop',
+  [0x126] = 'CropOverlay',
+  [0x127] = 'Select1Left',
+  [0x128] = 'Select1Right',
+  [0x129] = 'ToggleZoomOffOn',
+  [0x12a] = 'SwToMlibrary',
+  [0x12b] = 'SwToMdevelop',
+  [0x130] = 'CropTopLeft',
+  [0x131] = 'CropTopRight',
+  [0x132] = 'CropBottomLeft',
+  [0x133] = 'CropBottomRight',
+  [0x134] = 'CropAll',
+  [0x201] = 'Temperature',
+  [0x202] = 'Tint',
+  [0x203] = 'Exposure',
+  [0x204] = 'Highlights',
+  [0x205] = 'Shadows',
+  [0x206] = 'Brightness',
+  [0x207] = 'Contrast',
+  [0x208] = 'Blacks',
+  [0x209] = 'Whites',
+  [0x20a] = 'Clarity',
+  [0x20b] = 'Vibrance',
+  [0x20c] = 'Saturation',
+  [0x20d] = 'Dehaze',
+  [0x20e] = 'Texture',
+  [0x210] = 'ParametricDarks',
+  [0x211] = 'ParametricLights',
+  [0x212] = 'ParametricShadows',
+  [0x213] = 'ParametricHighlights',
+  [0x214] = 'ParametricShadowSplit',
+  [0x215] = 'ParametricMidtoneSplit',
+  [0x216] = 'ParametricHighlightSplit',
+  [0x218] = 'EnableToneCurve',
+  [0x220] = 'GrayMixerRed',
+  [0x221] = 'GrayMixerOrange',
+  [0x222] = 'GrayMixerYellow',
+  [0x223] = 'GrayMixerGreen',
+  [0x224] = 'GrayMixerAqua',
+  [0x225] = 'GrayMixerBlue',
+  [0x226] = 'GrayMixerPurple',
+  [0x227] = 'GrayMixerMagenta',
+  [0x228] = 'EnableColorAdjustments',
+  [0x229] = 'AllSaturationAdjustment',
+  [0x230] = 'SaturationAdjustmentRed',
+  [0x231] = 'SaturationAdjustmentOrange',
+  [0x232] = 'SaturationAdjustmentYellow',
+  [0x233] = 'SaturationAdjustmentGreen',
+  [0x234] = 'SaturationAdjustmentAqua',
+  [0x235] = 'SaturationAdjustmentBlue',
+  [0x236] = 'SaturationAdjustmentPurple',
+  [0x237] = 'SaturationAdjustmentMagenta',
+  [0x240] = 'HueAdjustmentRed',
+  [0x241] = 'HueAdjustmentOrange',
+  [0x242] = 'HueAdjustmentYellow',
+  [0x243] = 'HueAdjustmentGreen',
+  [0x244] = 'HueAdjustmentAqua',
+  [0x245] = 'HueAdjustmentBlue',
+  [0x246] = 'HueAdjustmentPurple',
+  [0x247] = 'HueAdjustmentMagenta',
+  [0x250] = 'LuminanceAdjustmentRed',
+  [0x251] = 'LuminanceAdjustmentOrange',
+  [0x252] = 'LuminanceAdjustmentYellow',
+  [0x253] = 'LuminanceAdjustmentGreen',
+  [0x254] = 'LuminanceAdjustmentAqua',
+  [0x255] = 'LuminanceAdjustmentBlue',
+  [0x256] = 'LuminanceAdjustmentPurple',
+  [0x257] = 'LuminanceAdjustmentMagenta',
+  [0x260] = 'EnableSplitToning',
+  [0x261] = 'SplitToningBalance',
+  [0x262] = 'SplitToningShadowHue',
+  [0x263] = 'SplitToningShadowSaturation',
+  [0x264] = 'SplitToningHighlightHue',
+  [0x265] = 'SplitToningHighlightSaturation',
+  [0x270] = 'EnableDetail',
+  [0x271] = 'Sharpness',
+  [0x272] = 'SharpenRadius',
+  [0x273] = 'SharpenDetail',
+  [0x274] = 'SharpenEdgeMasking',
+  [0x275] = 'LuminanceSmoothing',
+  [0x276] = 'LuminanceNoiseReductionDetail',
+  [0x277] = 'LuminanceNoiseReductionContrast',
+  [0x278] = 'ColorNoiseReduction',
+  [0x279] = 'ColorNoiseReductionDetail',
+  [0x27a] = 'ColorNoiseReductionSmoothness',
+  [0x300] = 'Pick',
+  [0x301] = 'Reject',
+  [0x302] = 'RemoveFlag',
+  [0x303] = 'ToggleRed',
+  [0x304] = 'ToggleGreen',
+  [0x305] = 'ToggleBlue',
+  [0x306] = 'TogglePurple',
+  [0x307] = 'ToggleYellow',
+  [0x308] = 'AddOrRemoveFromTargetColl',
+  [0x309] = 'RotateLeft',
+  [0x30a] = 'RotateRight',
+  [0x30b] = 'EditPhotoshop',
+  [0x30c] = 'openExportDialog',
+  [0x30d] = 'openExportWithPreviousDialog',
+  [0x30e] = 'ColorLabelNone',
+}
+local byName = {}
+for id, name in pairs(byId) do byName[name] = id end
+return { byId = byId, byName = byName }
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Python 3 only; TangentBridge.py imports this on demand (--engine=asyncio).
+
+# This module provides an asyncio event engine for the bridge.
+# Each of the three sockets (Tangent, LR send, LR receive) is driven by its own task,
+# so a slow reply from Lightroom never holds up input from the panel.
+# The protocol logic and connection management are unchanged; they are all inherited from Bridge.
+
+import asyncio
+
+from TangentBridge import Bridge, LINKS
+
+class AsyncioBridge(Bridge):
+    def __init__(self, pluginPath, **options):
+        ''' Takes the same options as Bridge, but needs real sockets: the transport may be a TcpTransport or SocketPairTransport '''
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.watchingWritable = set()
+        self.halted = self.loop.create_future()
+        self.connected = dict( (name, asyncio.Event()) for name, _ in LINKS )
+        self.waiting = {} # socket -> future for a task waiting for it to become readable
+        super(AsyncioBridge, self).__init__(pluginPath, **options)
+
+    def linkUp(self, name, sock):
+        super(AsyncioBridge, self).linkUp(name, sock)
+        self.connected[name].set()
+
+    def closeLink(self, name):
+        sock = getattr(self, name)
+        if sock is not None:
+            # Unhook the socket from the loop before it is closed, and wake its task so it can wait for a new one
+            self.connected[name].clear()
+            if sock in self.watchingWritable:
+                self.loop.remove_writer(sock)
+                self.watchingWritable.discard(sock)
+            fut = self.waiting.pop(sock, None)
+            if fut is not None:
+                self.loop.remove_reader(sock)
+                if not fut.done():
+                    fut.set_result(None)
+        super(AsyncioBridge, self).closeLink(name)
+
+    def flushAll(self):
+        ''' Writes what the sockets will take, then watches for writability on any that are backed up '''
+        super(AsyncioBridge, self).flushAll()
+        pending = set(self.writePending())
+        for s in pending - self.watchingWritable:
+            self.loop.add_writer(s, self.writable, s)
+        for s in self.watchingWritable - pending:
+            self.loop.remove_writer(s)
+        self.watchingWritable = pending
+        # Everything we do ends with a flush, so this is a good place to notice we've been told to stop
+        if self.halt and not self.halted.done():
+            self.halted.set_result(None)
+
+    def writable(self, sock):
+        self.flushAll()
+        self.runLRSendQ()
+        self.flushAll()
+
+    def callLater(self, delay, fn, *args):
+        ''' Schedules fn(*args) on the asyncio loop. The returned handle has a cancel() method. '''
+        return self.loop.call_later(delay, self.fire, fn, args)
+
+    def fire(self, fn, args):
+        fn(*args)
+        self.flushAll()
+
+    # -----------------------------------------------------------------
+
+    async def readable(self, sock):
+        ''' Waits until the socket has data, has closed, or has been dropped by closeLink '''
+        fut = self.loop.create_future()
+        self.waiting[sock] = fut
+        self.loop.add_reader(sock, fut.set_result, None)
+        try:
+            await fut
+        finally:
+            if self.waiting.pop(sock, None) is not None:
+                self.loop.remove_reader(sock)
+
+    async def linkTask(self, name, inbound):
+        ''' Services one link: waits for it to be connected, then for data, then handles it '''
+        while not self.halt:
+            sock = getattr(self, name)
+            if sock is None:
+                await self.connected[name].wait()
+                continue
+            await self.readable(sock)
+            if getattr(self, name) is sock:
+                # The receive buffers take everything available and handle every complete message
+                inbound()
+            self.flushAll()
+
+    async def main(self):
+        tasks = [ self.loop.create_task(self.linkTask(name, inbound)) for name, inbound in [
+            ('Tangent', self.inboundTangent),
+            ('LRRecv', self.inboundLR),
+            ('LRSend', self.inboundLRAck),
+        ] ]
+        await asyncio.wait(tasks + [self.halted], return_when=asyncio.FIRST_COMPLETED)
+        for t in tasks:
+            t.cancel()
+        for s in self.watchingWritable:
+            self.loop.remove_writer(s)
+
+    def run(self):
+        ''' Main loop, runs until termination command received '''
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+        self.logStats()
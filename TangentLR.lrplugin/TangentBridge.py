@@ -1,20 +1,27 @@
 #!/usr/bin/env python
 # Written to work on both Python 2 and 3 (OSX provides 2.7)
 
+import argparse
 import binascii
+import collections
+import errno
+import heapq
 import os
-import select
 import socket
-import struct
 import sys
-if sys.version_info[0] < 3:
-    import Queue
-    PYTHON3=False
-else:
-    import queue as Queue
-    PYTHON3=True
-
-from TangentMapping import ALL_MENUS
+import time
+PYTHON3 = sys.version_info[0] >= 3
+
+from TangentBuffers import FrameBuffer, FramingError, LineBuffer, SendBuffer
+from TangentCodec import rd4, tobytes, tobin, u4, encconst, noFields, oneInt, twoInts, intFloat, oneStr, strFloat, \
+        paramValueFrame, modeChangeFrame, menuStringFrame, customParamTemplate, customParamValueFrame, lrMessage, \
+        PROTOCOL_COMPACT, PROTOCOL_TRACKING, PROTOCOL_PHOTOS, TEXT_ONLY, compactMessage, readCompact, \
+        lrListMessage
+from TangentScheduler import Coalescer, Accumulator, Shuttle, GestureTracker, RateController, PriorityScheduler, \
+        ReadQueue, COALESCE_WINDOW, JOG_WINDOW, SHUTTLE_RATE, GESTURE_IDLE, TARGET_LATENCY
+from TangentCache import ParamCache, LocalEdits, CACHE_MAX_AGE, ECHO_SETTLE
+from TangentTransport import TcpTransport
+from TangentMapping import ALL_MENUS, ALL_MACROS
 import TangentMappingDefinitions
 
 TANGENT_PORT = 64246
@@ -24,31 +31,23 @@ LRRECV_PORT = 54779
 
 APPNAME = 'Adobe Lightroom Classic'
 
-def connect(port, address='127.0.0.1'):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((address,port))
-    return sock
-
-# Packet wrangling syntactic sugar
-def rd4(seq, pos=0):
-    return struct.unpack(">i", seq[pos:pos+4])[0]
-def rd4f(seq, pos=0):
-    return struct.unpack(">f", seq[pos:pos+4])[0]
-def rd4multi(seq, pos, n):
-    return [ rd4(seq, pos*i+4) for i in range(n)]
-def u4(i):
-    return bytearray(struct.pack('>i', i))
-def rdstr(seq,pos):
-    # returns (string, how far to advance the stream)
-    length = rd4(seq,pos)
-    return seq[pos+4:pos+4+length], 4+length
-def encstr(s):
-    if type(s) is str and PYTHON3:
-        s = bytes(s, 'utf-8')
-    return u4(len(s)) + s
-def encf(f):
-    return bytearray(struct.pack('>f', f))
+# Event engines selectable with --engine. The asyncio engine lives in TangentAsyncio.py (Python 3 only).
+ENGINES = ['select', 'asyncio']
+
+# time.monotonic and time.perf_counter are Python 3 only
+monotonic = getattr(time, 'monotonic', time.time)
+clock = getattr(time, 'perf_counter', time.time)
+
+# Our three connections ("links"): the Bridge attribute holding each socket, and its port.
+LINKS = [ ('Tangent', TANGENT_PORT), ('LRSend', LRSEND_PORT), ('LRRecv', LRRECV_PORT) ]
 
+# When a link drops we retry it on its own, backing off from RECONNECT_MIN to RECONNECT_MAX seconds between tries.
+RECONNECT_MIN = 0.01
+RECONNECT_MAX = 2.0
+# If a link stays down this long (seconds), Lightroom or the Hub has gone away for good and we exit.
+RECONNECT_GIVEUP = 60
+
+# Debug helpers
 def split(seq, length=4):
     ''' splits data into words '''
     return [seq[i:i+length] for i in range(0, len(seq), length)]
@@ -89,63 +88,432 @@ for group in TangentMappingDefinitions.controls.groups:
 # Current values, indexed by ID [for now]
 VALUES = {}
 
+# Custom parameters are those the Hub refers to by name rather than by ID.
+class CustomParam(object):
+    by_name = {} # keyed by both the text and the bytes of each name
+    by_slot = []
+
+    def __init__(self, name):
+        self.slot = len(CustomParam.by_slot)
+        self.name = name
+        self.resetName = 'Reset' + name
+        self.template = customParamTemplate(name) # for 0xa6 replies
+        CustomParam.by_slot.append(self)
+        CUSTOM_VALUES.append(None)
+        CustomParam.by_name[name] = self
+        CustomParam.by_name[tobin(name)] = self
+
+    @staticmethod
+    def get(name):
+        ''' Returns the parameter with this name (text or UTF-8 bytes), interning it the first time it is seen '''
+        p = CustomParam.by_name.get(name)
+        if p is None:
+            if PYTHON3 and isinstance(name, bytes):
+                name = name.decode('utf-8')
+            p = CustomParam(name)
+        return p
+
+# Current values of custom parameters, indexed by slot
+CUSTOM_VALUES = []
+
 ALL_MODES = TangentMappingDefinitions.controls.modes
 
+# mode id -> [(id, name)] of the parameters mapped to controls in that mode, on any panel
+MODE_PARAMETERS = {}
+for mode in ALL_MODES:
+    MODE_PARAMETERS[mode.id] = []
+    for mapFile in TangentMappingDefinitions.panel_maps:
+        for key in mapFile.mode_keys(mode.id):
+            ctrl = Control.by_id.get(key)
+            # Parameters are the controls with values; leave out custom controls, which are ours
+            if ctrl is not None and ctrl.MaxValue is not None and key < 0x40000000 \
+                    and (key, ctrl.name) not in MODE_PARAMETERS[mode.id]:
+                MODE_PARAMETERS[mode.id].append((key, ctrl.name))
+
+# Macro timing (seconds), as in MIDI2LR's action series: the gap between steps, and how long a Pause step waits
+MACRO_GAP = 0.01
+MACRO_PAUSE = 0.02
+
+# Most parameters to ask LR for in one GetValues message
+READ_BATCH = 32
+# Most messages to have sent LR without an acknowledgement
+LR_WINDOW = 8
+# Of those, most which may be reads
+READS_IN_FLIGHT = 2
+# If a message goes this long (seconds) without an acknowledgement, we stop waiting for them
+ACK_TIMEOUT = 2.0
+# A read LR hasn't answered in this time (seconds) is taken to be lost, so the Hub's reads go to LR again
+READ_TIMEOUT = ACK_TIMEOUT
+# Priority classes of messages to LR, as indexes into Bridge.lrScheduler
+LR_ACTIONS, LR_WRITES, LR_READS = 0, 1, 2
+READS_HELD = (LR_READS,)
+READ_LABELS = ('GetValue', 'GetValues')
+# Label in lrInFlight of the shuttle's step, so only its own ack releases the next one
+SHUTTLE_LABEL = 'ShuttleStep'
+# Messages after which we can't trust what we know of LR's values until it tells us again
+CACHE_INVALIDATORS = ('StepPhotos', 'Next', 'Prev', 'Select1Left', 'Select1Right', 'Undo', 'Redo')
+# ...and actions (or menu verbs) by prefix which set parameters themselves
+VALUE_SETTERS = ('AutoTone', 'WhiteBalance', 'QuickDevWB', 'SetTreatment', 'PointCurve')
+# Actions which have nothing to do with the photo's values or history, so may overtake changes made before them.
+# Every other action waits its turn behind those changes.
+INDEPENDENT_ACTIONS = ('ShowClipping', 'ToggleZoomOffOn', 'CropOverlay', 'Pick', 'Reject', 'RemoveFlag',
+        'ToggleRed', 'ToggleGreen', 'ToggleBlue', 'TogglePurple', 'ToggleYellow', 'ColorLabelNone',
+        'AddOrRemoveFromTargetColl')
+
+def invalidates(action):
+    return action in CACHE_INVALIDATORS or action.startswith(VALUE_SETTERS)
+
+# Names which can be sent by id in the compact encoding, and their ids
+COMPACT_IDS = TangentMappingDefinitions.controls.compact_ids()
+
 ##############################################################
 
+class Timer(object):
+    ''' Handle for a callback scheduled by Bridge.callLater '''
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+# Tangent command dispatch.
+# Each command code has a Bridge method registered with @tangentCommand, which is passed the packet's fields
+# as parsed by the given TangentCodec function. Commands which carry a control id (controlId=True) send ids
+# with CUSTOM_ID set to the method registered with @customControl for that command and id instead.
+CUSTOM_ID = 0x40000000
+TANGENT_COMMANDS = {} # command code -> (method, field parser, carries a control id)
+CUSTOM_CONTROLS = {} # (command code, control id) -> method
+
+def tangentCommand(code, parse, controlId=False):
+    def register(fn):
+        TANGENT_COMMANDS[code] = (fn, parse, controlId)
+        return fn
+    return register
+
+def customControl(code, id):
+    def register(fn):
+        CUSTOM_CONTROLS[(code, id)] = fn
+        return fn
+    return register
+
+class Timing(object):
+    ''' Counts occurrences of something, and how long they took '''
+    def __init__(self, label, unit='calls'):
+        self.label = label
+        self.unit = unit
+        self.count = 0
+        self.elapsed = 0.0 # seconds, in total
+        self.slowest = 0.0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.elapsed += elapsed
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+
+    def stats(self):
+        return '%-30s %8d %s, mean %7.1f us, max %8.1f us' % (self.label, self.count, self.unit,
+                1e6 * self.elapsed / self.count, 1e6 * self.slowest)
+
+class Command(Timing):
+    ''' A command handler, with usage statistics '''
+    def __init__(self, label, fn, parse=noFields, controlId=False):
+        super(Command, self).__init__(label)
+        self.fn = fn
+        self.parse = parse
+        self.controlId = controlId
+
 class Bridge(object):
-    def __init__(self, pluginPath):
+    def __init__(self, pluginPath, transport=None, compact=True, coalesce=COALESCE_WINDOW, jog=JOG_WINDOW,
+            window=LR_WINDOW, latency=TARGET_LATENCY, reads=READS_IN_FLIGHT, gesture=GESTURE_IDLE,
+            shuttle=SHUTTLE_RATE, cache=CACHE_MAX_AGE, prefetch=True, echo=ECHO_SETTLE):
+        '''
+        transport defaults to TCP connections to the Hub and Lightroom; see TangentTransport.
+        compact says whether to offer the plugin the compact encoding (see TangentCodec).
+        coalesce is the window (seconds) in which encoder updates to a parameter are merged; see TangentScheduler.
+        jog is the window (seconds) in which transport ring steps are added up into one move.
+        shuttle is the photos per second to step for each unit the shuttle ring is turned off centre.
+        cache is how long (seconds) a value from LR may be used to answer the Hub without asking LR again.
+        prefetch says whether to send the Hub a mode's parameters as soon as it changes, rather than wait to be asked.
+        echo is how long (seconds) LR has to agree with a value the Hub was shown ahead of it; 0 to always wait for LR.
+        window is the most messages we will have sent LR but not had acknowledged.
+        latency is the round trip time to LR (seconds) the send rate is adjusted to keep within; 0 for no limit.
+        reads is the most read messages (each of which may ask for several parameters) to have in that window.
+        gesture is how long (seconds) a parameter must be left alone for a turn of its dial to count as finished.
+        '''
         self.pluginInfo = pluginPath
         self.pluginDir = os.path.abspath(os.path.dirname(pluginPath))
         # Initialise these first in case connection fails
         self.Tangent = None
         self.LRSend = None
         self.LRRecv = None
-        self.lrQueue = Queue.Queue()
-        self.lrSendInProgress= False
+        self.transport = transport or TcpTransport()
+        self.tangentIn = FrameBuffer()
+        self.lrIn = LineBuffer()
+        self.lrInHighWater = 0
+        self.outBuffers = {} # socket -> SendBuffer
+        # Messages waiting to go to LR, in priority order: actions, parameter writes, then reads
+        self.lrActions = collections.deque() # [label, message]
+        self.lrWrites = collections.deque() # [label, message]
+        self.lrWriteEntries = {} # parameter name -> its entry in lrWrites, while it can still be superseded
+        self.lrQueue = ReadQueue() # parameters waiting to be read, tagged with the mode they were asked for in
+        self.maxReads = reads
+        self.readsInFlight = 0
+        self.readTimer = None
+        self.lrReading = {} # name -> (mode, time sent), for reads sent to LR but not yet answered
+        self.readsCancelled = 0
+        self.lateReplies = 0 # answers to reads from an earlier mode, which were not passed on
+        self.lrScheduler = PriorityScheduler([('actions', self.lrActions), ('writes', self.lrWrites),
+                ('reads', self.lrQueue)])
+        self.lrSuperseded = 0
+        self.rate = RateController(latency)
+        self.rateTimer = None
+        self.lrInFlight = collections.deque() # (label, time sent) for each message LR has yet to acknowledge
+        self.lrWindow = window
+        self.lrAcked = True # LR acknowledges our messages; assumed until one goes missing
+        self.lrAckSeen = False # LR has acknowledged something on this connection
+        self.lrOwed = 0 # acks still to come for messages we stopped waiting for
+        self.ackTail = b''
+        self.ackTimer = None
+        self.lrRtt = {} # label -> Timing of round trips
+        self.lrSrtt = None # smoothed round trip time, seconds
+        self.offerCompact = compact
+        self.lrProtocol = None # protocol version the plugin has agreed to, if it knows about versions at all
+        self.lrCompact = False # the plugin has agreed to the compact encoding
+        self.lrTracking = False # the plugin has agreed to StartTracking/StopTracking
+        self.cache = ParamCache(cache)
+        self.prefetchModes = prefetch
+        self.localEdits = LocalEdits(self.callLater, self.lrCorrected, self.readLR, settle=echo)
+        self.coalescer = Coalescer(self.callLater, self.sendLR, coalesce)
+        self.jog = Accumulator(self.callLater, self.stepPhotos, jog)
+        self.shuttle = Shuttle(self.callLater, self.shuttleStep, shuttle)
+        self.macros = collections.deque() # steps of each macro waiting to run, the current one first
+        self.gestures = GestureTracker(self.callLater, self.startTracking, self.stopTracking, gesture)
         self.udsm = 0
+        self.modeId = None
+        self.visibleParams = [] # parameter names the Hub has read since the last mode change
+        self.timers = []
+        self.halt = False
+        self.downSince = {} # link name -> when it went down
+        self.backoff = {} # link name -> delay before its next reconnect attempt
+        self.commands = dict( (code, Command('0x%02x %s' % (code, fn.__name__), fn, parse, controlId))
+                for code, (fn, parse, controlId) in TANGENT_COMMANDS.items() )
+        self.customControls = dict( (key, Command('0x%02x %08x %s' % (key[0], key[1], fn.__name__), fn))
+                for key, fn in CUSTOM_CONTROLS.items() )
         self.log('Starting up, plugin dir is %s'%self.pluginDir)
         self.connectAll()
 
     def __del__(self):
         self.closeAll()
 
+    # -----------------------------------------------------------------
+    # Connection management
+
     def connectAll(self):
-        self.closeAll()
-        self.Tangent = connect(TANGENT_PORT)
-        self.Tangent.setblocking(False)
-        self.LRSend = connect(LRSEND_PORT)
-        self.LRSend.setblocking(False)
-        self.LRRecv = connect(LRRECV_PORT)
-        self.LRRecv.setblocking(False)
+        ''' Connects every link which is down, in parallel. Any that fail are retried in the background. '''
+        down = [ (name, port) for name, port in LINKS if getattr(self, name) is None ]
+        results = self.transport.connect(down)
+        for name, _ in down:
+            if isinstance(results[name], socket.error):
+                self.linkFailed(name, results[name])
+            else:
+                self.linkUp(name, results[name])
 
     def closeAll(self):
-        if self.Tangent:
-            self.Tangent.close()
-        if self.LRSend:
-            self.LRSend.close()
-        if self.LRRecv:
-            self.LRRecv.close()
+        # N.B. called from __del__, when module globals such as LINKS may already be gone
+        for name in ('Tangent', 'LRSend', 'LRRecv'):
+            self.closeLink(name)
+
+    def closeLink(self, name):
+        sock = getattr(self, name)
+        if sock is None:
+            return
+        self.outBuffers.pop(sock, None)
+        sock.close()
+        setattr(self, name, None)
+
+    def linkUp(self, name, sock):
+        setattr(self, name, sock)
+        self.outBuffers[sock] = SendBuffer()
+        if name == 'Tangent':
+            self.tangentIn = FrameBuffer()
+        elif name == 'LRRecv':
+            self.lrIn = LineBuffer()
+        else:
+            # Anything in flight or waiting was for the old connection
+            self.lrActions.clear()
+            self.lrWrites.clear()
+            self.lrWriteEntries.clear()
+            self.lrReading.clear()
+            self.lrInFlight.clear()
+            self.readsInFlight = 0
+            self.shuttle.stepped()
+            self.lrAcked = True
+            self.lrAckSeen = False
+            self.lrOwed = 0
+            self.ackTail = b''
+        if name != 'Tangent':
+            # Lightroom (re)connected: start out in the plain MIDI2LR protocol, and offer our extensions
+            self.lrProtocol = None
+            self.lrCompact = False
+            self.lrTracking = False
+            self.gestures.clear()
+            self.localEdits.clear()
+            self.cache.invalidate()
+            if self.LRSend and self.LRRecv:
+                offer = '%d' % PROTOCOL_PHOTOS if self.offerCompact else '%d %s' % (PROTOCOL_PHOTOS, TEXT_ONLY)
+                self.sendLR('Protocol', offer)
+        self.backoff[name] = RECONNECT_MIN
+        since = self.downSince.pop(name, None)
+        if since is None:
+            return
+        self.log('%s link reconnected after %.0f ms' % (name, 1000 * (monotonic() - since)))
+        # The Hub reinitialises by itself when it reconnects; Lightroom needs us to bring it up to date.
+        if name != 'Tangent' and self.LRSend and self.LRRecv:
+            self.resync()
+
+    def linkDown(self, name, why):
+        ''' Drops a link which has failed, and starts trying to bring it back '''
+        if getattr(self, name) is None:
+            return
+        self.log('%s link lost (%s); reconnecting' % (name, why))
+        self.closeLink(name)
+        self.linkFailed(name, why)
+
+    def linkFailed(self, name, why):
+        if name not in self.downSince:
+            self.downSince[name] = monotonic()
+            self.log('%s link down (%s); will keep trying' % (name, why))
+        delay = self.backoff.get(name, RECONNECT_MIN)
+        self.backoff[name] = min(2 * delay, RECONNECT_MAX)
+        self.callLater(delay, self.reconnect, name)
+
+    def reconnect(self, name):
+        if self.halt or getattr(self, name) is not None:
+            return
+        if monotonic() - self.downSince[name] > RECONNECT_GIVEUP:
+            self.log('%s link has been down for %d seconds; giving up' % (name, RECONNECT_GIVEUP))
+            self.halt = True
+            return
+        result = self.transport.connect([ (name, dict(LINKS)[name]) ])[name]
+        if isinstance(result, socket.error):
+            self.linkFailed(name, result)
+        else:
+            self.linkUp(name, result)
+
+    def resync(self):
+        ''' After Lightroom reconnects, refreshes just what the panel is showing: the current mode's parameters, and the menus '''
+        if self.Tangent is None or self.modeId is None:
+            return
+        self.log('Resyncing mode %08x: %d parameters' % (self.modeId, len(self.visibleParams)))
+        for name in self.visibleParams:
+            self.readLR(name)
+        for id, mnu in ALL_MENUS.items():
+            display, _ = mnu.get()
+            self.sendFrame(menuStringFrame(id, display))
+
+    def linkName(self, sock):
+        for name, _ in LINKS:
+            if getattr(self, name) is sock:
+                return name
 
     def log(self, msg):
         print(msg)
         # TODO: write to logfile?
 
+    def send(self, sock, *chunks):
+        '''
+        Queues a message (made up of one or more chunks) for one of our sockets.
+        Everything queued is written out by flushAll(), once per pass of the event loop.
+        If the peer isn't keeping up and the socket's buffer is full, the message is dropped.
+        '''
+        buf = self.outBuffers.get(sock)
+        if buf is None:
+            return # link is down; we'll resync when it comes back
+        if not buf.write(*chunks) and buf.dropped == 1:
+            self.log('!!! %s send buffer full (%d bytes); dropping messages' % (self.linkName(sock), len(buf)))
+
+    def flushAll(self):
+        ''' Writes out as much as each socket will take without blocking '''
+        for sock, buf in list(self.outBuffers.items()):
+            try:
+                buf.flush(sock)
+            except socket.error as e:
+                self.linkDown(self.linkName(sock), e)
+
+    def writePending(self):
+        ''' Returns the sockets which have data waiting to be written '''
+        return [ s for s, buf in self.outBuffers.items() if buf.pending ]
+
+    def queueDepths(self):
+        ''' Returns the number of bytes waiting to be written, by link name '''
+        return dict( (self.linkName(s), len(buf)) for s, buf in self.outBuffers.items() )
+
+    def callLater(self, delay, fn, *args):
+        ''' Schedules fn(*args) to run on the event loop after delay seconds. Returns a handle with a cancel() method. '''
+        t = Timer(monotonic() + delay, fn, args)
+        heapq.heappush(self.timers, t)
+        return t
+
+    def runTimers(self):
+        ''' Fires any timers which are due. Returns the number of seconds until the next one, or None if there are none. '''
+        while self.timers:
+            t = self.timers[0]
+            if t.cancelled:
+                heapq.heappop(self.timers)
+                continue
+            delay = t.when - monotonic()
+            if delay > 0:
+                return delay
+            heapq.heappop(self.timers)
+            t.fn(*t.args)
+        return None
+
     # -----------------------------------------------------------------
     # Tangent logic
 
     def sendTangent(self, pkt):
         ''' Sends a Tangent packet. This function takes care of sending the length word. '''
-        s = self.Tangent
-        s.sendall(u4(len(pkt)))
-        pkt = bytearray(pkt)
-        s.sendall(pkt)
+        self.send(self.Tangent, u4(len(pkt)), pkt)
+
+    def sendFrame(self, frame):
+        ''' Sends a Tangent packet which already has its length word (see TangentCodec) '''
+        self.send(self.Tangent, frame)
 
     def changeMode(self, mode):
         self.log('ChangeMode %08x'%mode)
-        self.sendTangent(u4(0x85) + u4(mode))
+        self.sendFrame(modeChangeFrame(mode))
+        self.modeId = mode
+        self.visibleParams = []
+        # The Hub will read the new mode's parameters; those still waiting from the old one are not wanted
+        cancelled = self.lrQueue.drop(lambda name, readMode: readMode != mode)
+        if cancelled:
+            self.log('Cancelled %d reads from before the mode change' % cancelled)
+            self.readsCancelled += cancelled
+        if self.prefetchModes:
+            self.prefetch(mode)
         self.modeIndex = TangentMappingDefinitions.controls.find_mode_index(mode)
         self.log('new index %d'%self.modeIndex)
+
+    def prefetch(self, mode):
+        '''
+        Sends the Hub the values of the parameters a mode shows, without waiting for it to ask:
+        from the cache if we can, otherwise read from LR all together.
+        '''
+        for id, name in MODE_PARAMETERS.get(mode, ()):
+            self.noteVisible(name)
+            value = self.cache.get(name)
+            if value is not None:
+                self.sendFrame(paramValueFrame(id, value))
+            else:
+                self.readLR(name)
+
     def nextMode(self, step):
         prev = self.modeIndex
         self.modeIndex += step
@@ -160,148 +528,258 @@ class Bridge(object):
     def handleTangent(self, pkt):
         ''' Deal with a single Tangent command '''
         cmd = rd4(pkt)
-        if cmd==1:
-            protocol, npanels = rd4multi(pkt, 4, 2)
-            self.log('Tangent Initiate Comms: protocol %d, %d panels'%(protocol,npanels))
-            # We don't really care about the panel type data
-            self.sendTangent(u4(0x81) + encstr(APPNAME) + encstr(self.pluginDir) + encstr(''))
-            #self.sendLR('GetPluginInfo', 1)
-            # Initial Mode: Colour/Tone
-            self.changeMode(1)
-            self.sendLR('SwToMdevelop', 1)
-
-        # Mode switching
-        elif cmd==9:
-            mode = rd4(pkt, 4)
-            self.log('CHANGE MODE: %08x'%mode)
-            self.changeMode(mode)
-            self.sendLR('SwToMdevelop', 1)
-
-        # Parameters. Note that these always range from 0 to 1 in midi2lr's world; it keeps a mapping.
-        elif cmd==2:
-            param,incr = rd4(pkt,4), rd4f(pkt,8)
-            if param & 0x40000000:
-                return self.encoderCustom(param, incr=incr)
-            control = Control.by_id[param]
-            name = control.name
-            if param not in VALUES:
-                VALUES[param]=0.5 # safeish default?
-                self.log('!!! no param for ' + name)
-                #self.sendLR('GetValue', name)
-            newvalue = VALUES[param] + incr
-            newvalue = max( min(newvalue, control.MaxValue), control.MinValue )
-            VALUES[param] = newvalue
-            self.log('T< Param Change: 0x%x (%s): %f -> %f'%(param,name,incr,newvalue))
-            self.sendLR(name, newvalue)
-        elif cmd==4:
-            param = rd4(pkt,4)
-            name = Control.name_for(param)
-            self.log('T< READ PARAM: 0x%x (%s)'%(param,name))
-            if param & 0x40000000:
-                return self.encoderCustom(param)
-            #self.log('>>> GetValue %s'%name)
-            self.sendLRQueued('GetValue', name)
-            # And the response will DTRT (--> 0x82)
-        elif cmd==3: # Reset param (knob pushed)
-            param = rd4(pkt,4)
-            name = Control.name_for(param)
-            self.log('T< RESET PARAM: 0x%x (%s)'%(param,name))
-            if param & 0x40000000:
-                return self.encoderCustom(param, reset=True)
-            self.sendLR('Reset'+name, '1')
-
-        # Custom Parameters.
-        elif cmd==0x36:
-            name,offset = rdstr(pkt, 4)
-            incr = rd4f(pkt, 4+offset)
-            self.log('T< CUSTOM PARAM: %s, %f'%(name,incr))
-            VALUES[name] += incr
-            self.log('T< Param Change: %s: %f -> %f'%(name,incr,VALUES[name]))
-            self.sendLR(name, VALUES[name])
-        elif cmd==0x37:
-            name,_ = rdstr(pkt, 4)
-            self.log('T< CUSTOM PARAM RESET: %s'%name)
-            self.sendLR('Reset'+name, '1')
-        elif cmd==0x38:
-            name,_ = rdstr(pkt, 4)
-            self.log('T< READ CUSTOM PARAM: %s'%name)
-            self.sendLRQueued('GetValue', name)
-            # And the response will DTRT (--> 0xa6)
-
-        # Button actions. We generally action on DOWN and ignore UP, but there are special cases.
-        elif cmd==8:
-            action = rd4(pkt,4)
-            if action & 0x40000000:
-                self.buttonCustom(action, up=False)
+        h = self.commands.get(cmd)
+        if h is None:
+            self.log('T< ??? (0x%x): %s'%(cmd, hexdump(tobytes(pkt[4:]))))
+            return
+        args = h.parse(pkt)
+        if h.controlId and args[0] & CUSTOM_ID:
+            h = self.customControls.get((cmd, args[0]))
+            if h is None:
+                self.log('Unhandled custom control %08x (command 0x%x)'%(args[0], cmd))
                 return
-            name = Control.name_for(action)
-            self.log('T< ACTION ON: 0x%x (%s)'%(action,name))
-            self.sendLR(name, '1')
-        elif cmd==0xb:
-            action = rd4(pkt,4)
-            if action & 0x40000000:
-                self.buttonCustom(action, up=True)
+        start = clock()
+        h.fn(self, *args)
+        h.record(clock() - start)
+
+    def commandStats(self):
+        ''' Returns a line of statistics for each Tangent command we have handled, busiest first '''
+        used = [ h for h in list(self.commands.values()) + list(self.customControls.values()) if h.count ]
+        used.sort(key=lambda h: -h.count)
+        return [ h.stats() for h in used ]
+
+    @tangentCommand(1, twoInts)
+    def onInitiateComms(self, protocol, npanels):
+        self.log('Tangent Initiate Comms: protocol %d, %d panels'%(protocol,npanels))
+        # We don't really care about the panel type data
+        self.sendTangent(u4(0x81) + encconst(APPNAME) + encconst(self.pluginDir) + encconst(''))
+        #self.sendLR('GetPluginInfo', 1)
+        # Initial Mode: Colour/Tone
+        self.changeMode(1)
+        self.sendLR('SwToMdevelop', 1)
+
+    # Mode switching
+    @tangentCommand(9, oneInt)
+    def onModeChange(self, mode):
+        self.log('CHANGE MODE: %08x'%mode)
+        self.changeMode(mode)
+        self.sendLR('SwToMdevelop', 1)
+
+    # Parameters. Note that these always range from 0 to 1 in midi2lr's world; it keeps a mapping.
+    @tangentCommand(2, intFloat, controlId=True)
+    def onParamChange(self, param, incr):
+        control = Control.by_id[param]
+        name = control.name
+        if param not in VALUES:
+            VALUES[param]=0.5 # safeish default?
+            self.log('!!! no param for ' + name)
+            #self.sendLR('GetValue', name)
+        newvalue = VALUES[param] + incr
+        newvalue = float(max( min(newvalue, control.MaxValue), control.MinValue ))
+        VALUES[param] = newvalue
+        self.cache.put(name, newvalue)
+        self.log('T< Param Change: 0x%x (%s): %f -> %f'%(param,name,incr,newvalue))
+        if self.localEdits.enabled():
+            # Don't wait for LR to echo it back
+            self.sendFrame(paramValueFrame(param, newvalue))
+            self.localEdits.show(name, newvalue)
+        self.gestures.update(name)
+        self.coalescer.update(name, newvalue)
+
+    def startTracking(self, name):
+        ''' A dial has started turning: LR should make its changes into one history step '''
+        if self.lrTracking:
+            self.sendLR('StartTracking', name)
+
+    def stopTracking(self, name):
+        ''' The dial has stopped. Returns False if its last value has yet to go to LR, so it's too soon to say. '''
+        if name in self.coalescer.pending or name in self.lrWriteEntries:
+            return False
+        if self.lrTracking:
+            self.sendLR('StopTracking', name)
+
+    @tangentCommand(4, oneInt, controlId=True)
+    def onParamRead(self, param):
+        name = Control.name_for(param)
+        self.log('T< READ PARAM: 0x%x (%s)'%(param,name))
+        self.noteVisible(name)
+        value = self.cache.get(name)
+        if value is not None:
+            self.sendFrame(paramValueFrame(param, value))
+            return
+        if self.reading(name):
+            return # already on its way, prefetched
+        #self.log('>>> GetValue %s'%name)
+        self.readLR(name)
+        # And the response will DTRT (--> 0x82)
+
+    @tangentCommand(3, oneInt, controlId=True)
+    def onParamReset(self, param): # knob pushed
+        name = Control.name_for(param)
+        self.log('T< RESET PARAM: 0x%x (%s)'%(param,name))
+        self.coalescer.discard(name)
+        self.dropWrite(name)
+        self.localEdits.discard(name)
+        self.sendLR('Reset'+name, '1')
+
+    # Custom Parameters.
+    @tangentCommand(0x36, strFloat)
+    def onCustomParamChange(self, name, incr):
+        p = CustomParam.get(name)
+        self.log('T< CUSTOM PARAM: %s, %f'%(p.name,incr))
+        if CUSTOM_VALUES[p.slot] is None:
+            CUSTOM_VALUES[p.slot] = 0.5 # as for built-in parameters
+            self.log('!!! no param for ' + p.name)
+        CUSTOM_VALUES[p.slot] += incr
+        self.cache.put(p.name, CUSTOM_VALUES[p.slot])
+        self.log('T< Param Change: %s: %f -> %f'%(p.name,incr,CUSTOM_VALUES[p.slot]))
+        if self.localEdits.enabled():
+            self.sendFrame(customParamValueFrame(p.template, CUSTOM_VALUES[p.slot]))
+            self.localEdits.show(p.name, CUSTOM_VALUES[p.slot])
+        self.gestures.update(p.name)
+        self.coalescer.update(p.name, CUSTOM_VALUES[p.slot])
+
+    @tangentCommand(0x37, oneStr)
+    def onCustomParamReset(self, name):
+        p = CustomParam.get(name)
+        self.log('T< CUSTOM PARAM RESET: %s'%p.name)
+        self.coalescer.discard(p.name)
+        self.dropWrite(p.name)
+        self.localEdits.discard(p.name)
+        self.sendLR(p.resetName, '1')
+
+    @tangentCommand(0x38, oneStr)
+    def onCustomParamRead(self, name):
+        p = CustomParam.get(name)
+        self.log('T< READ CUSTOM PARAM: %s'%p.name)
+        self.noteVisible(p.name)
+        value = self.cache.get(p.name)
+        if value is not None:
+            self.sendFrame(customParamValueFrame(p.template, value))
+            return
+        self.readLR(p.name)
+        # And the response will DTRT (--> 0xa6)
+
+    # Button actions. We generally action on DOWN and ignore UP, but there are special cases.
+    @tangentCommand(8, oneInt, controlId=True)
+    def onActionOn(self, action):
+        name = Control.name_for(action)
+        self.log('T< ACTION ON: 0x%x (%s)'%(action,name))
+        macro = ALL_MACROS.get(action)
+        if macro is not None:
+            # One macro at a time, so their steps don't interleave
+            self.macros.append(macro.steps)
+            if len(self.macros) == 1:
+                self.runMacro(0)
+            return
+        self.sendLR(name, '1')
+
+    def runMacro(self, start):
+        '''
+        Sends the current macro's steps to LR from start on. They are paced, as MIDI2LR paces an action series,
+        but don't wait on LR or the panel.
+        '''
+        steps = self.macros[0]
+        for i in range(start, len(steps)):
+            if steps[i] == 'Pause':
+                self.callLater(MACRO_PAUSE, self.runMacro, i+1)
                 return
-            name = Control.name_for(action)
-            self.log('T< ACTION OFF: 0x%x (%s) (ignored)'%(action,name))
-        elif cmd==0x3c:
-            name,_ = rdstr(pkt, 4)
-            self.log('T< CUSTOM ACTION ON: %s'%name)
-            self.sendLR(name, '1')
-        elif cmd==0x3d:
-            name,_ = rdstr(pkt, 4)
-            self.log('T< CUSTOM ACTION OFF: %s'%name)
-
-
-        # Transport Ring. We use jog mode only.
-        elif cmd==0xa:
-            jog,shutl = rd4multi(pkt, 4, 2)
-            self.log('T< TRANSPORT: jog %d, shuttle %d'%(jog,shutl))
-            if jog<0:
-                for i in range(-jog):
-                    self.sendLR('Prev','1')
-            else:
-                for i in range(jog):
-                    self.sendLR('Next','1')
-
-        elif cmd==5:
-            id,incr = rd4multi(pkt, 4, 2)
-            display,verb = ALL_MENUS[id].change(incr)
-            self.log('T< MENU CHANGE: %08x, incr %d --> %s'%(id,incr,display))
-            self.log('>>> %s'%verb)
-            self.sendLR(verb, '1')
-            self.sendTangent(u4(0x83)+u4(id)+encstr(display)+u4(0))
-        elif cmd==6:
-            id = rd4(pkt, 4)
-            mnu = ALL_MENUS[id]
-            mnu.index = 0
-            display, verb = mnu.get()
-            self.log('T< MENU RESET: %08x --> %s'%(id,display))
-            self.log('>>> %s'%verb)
-            self.sendLR(verb, '1')
-            self.sendTangent(u4(0x83)+u4(id)+encstr(display)+u4(0))
-        elif cmd==7:
-            id = rd4(pkt, 4)
-            display, _= ALL_MENUS[id].get()
-            self.log('T< MENU STRING REQ: %08x --> %s'%(id,display))
-            self.sendTangent(u4(0x83)+u4(id)+encstr(display)+u4(0))
+            self.sendLR(steps[i], '1')
+            if i+1 < len(steps) and steps[i+1] != 'Pause':
+                self.callLater(MACRO_GAP, self.runMacro, i+1)
+                return
+        self.macros.popleft()
+        if self.macros:
+            self.callLater(MACRO_GAP, self.runMacro, 0)
 
-        else:
-            self.log('T< ??? (0x%x): %s'%(cmd, hexdump(pkt[4:])))
+    @tangentCommand(0xb, oneInt, controlId=True)
+    def onActionOff(self, action):
+        name = Control.name_for(action)
+        self.log('T< ACTION OFF: 0x%x (%s) (ignored)'%(action,name))
+
+    @tangentCommand(0x3c, oneStr)
+    def onCustomActionOn(self, name):
+        self.log('T< CUSTOM ACTION ON: %s'%name)
+        self.sendLR(name, '1')
+
+    @tangentCommand(0x3d, oneStr)
+    def onCustomActionOff(self, name):
+        self.log('T< CUSTOM ACTION OFF: %s'%name)
+
+    # Transport Ring. We use jog mode only.
+    @tangentCommand(0xa, twoInts)
+    def onTransport(self, jog, shutl):
+        self.log('T< TRANSPORT: jog %d, shuttle %d'%(jog,shutl))
+        if jog:
+            self.jog.add(jog)
+        if shutl != self.shuttle.offset:
+            self.shuttle.set(shutl)
+
+    def shuttleStep(self, n):
+        self.stepPhotos(n, SHUTTLE_LABEL)
+        if not self.lrAcked:
+            # No acks to say when LR has done it
+            self.shuttle.stepped()
+
+    def stepPhotos(self, n, label=None):
+        '''
+        Moves the selection n photos forwards, or backwards if n is negative.
+        label, if given, is what the (last) message is known by while it awaits acknowledgement.
+        '''
+        self.log('>>> StepPhotos %d'%n)
+        if self.lrProtocol is not None:
+            # One move, so Lightroom doesn't render every photo on the way
+            self.sendLR('StepPhotos', n, label)
+            return
+        for i in range(abs(n)):
+            self.sendLR('Prev' if n < 0 else 'Next', '1', label if i == abs(n) - 1 else None)
+
+    @tangentCommand(5, twoInts)
+    def onMenuChange(self, id, incr):
+        display,verb = ALL_MENUS[id].change(incr)
+        self.log('T< MENU CHANGE: %08x, incr %d --> %s'%(id,incr,display))
+        self.log('>>> %s'%verb)
+        self.sendLR(verb, '1')
+        self.sendFrame(menuStringFrame(id, display))
+
+    @tangentCommand(6, oneInt)
+    def onMenuReset(self, id):
+        mnu = ALL_MENUS[id]
+        mnu.index = 0
+        display, verb = mnu.get()
+        self.log('T< MENU RESET: %08x --> %s'%(id,display))
+        self.log('>>> %s'%verb)
+        self.sendLR(verb, '1')
+        self.sendFrame(menuStringFrame(id, display))
+
+    @tangentCommand(7, oneInt)
+    def onMenuStringRequest(self, id):
+        display, _= ALL_MENUS[id].get()
+        self.log('T< MENU STRING REQ: %08x --> %s'%(id,display))
+        self.sendFrame(menuStringFrame(id, display))
 
     def inboundTangent(self):
-        ''' Process inbound data from Tangent '''
-        s = self.Tangent
-        raw = None
+        ''' Process inbound data from Tangent. Handles every complete packet that has arrived. '''
+        buf = self.tangentIn
         try:
-            raw = s.recv(4)
+            buf.fill(self.Tangent)
         except socket.error as e:
-            self.log('Tangent socket closed (%s); bailing' % e)
-            self.halt = True
+            self.linkDown('Tangent', e)
             return
-        dlen = rd4(raw)
-        data = s.recv(dlen)
-        self.handleTangent(data)
+        try:
+            for pkt in buf.frames():
+                self.handleTangent(pkt)
+        except FramingError as e:
+            # We have lost track of the framing; a new connection starts it afresh
+            self.linkDown('Tangent', e)
+            return
+        if buf.closed:
+            self.linkDown('Tangent', 'closed by peer')
+
+    def noteVisible(self, name):
+        ''' Remembers that the panel is displaying a parameter, so we can refresh it later '''
+        if name not in self.visibleParams:
+            self.visibleParams.append(name)
 
     # Custom logic
     def upDownStateMachine(self, key, keyUp):
@@ -354,118 +832,424 @@ class Bridge(object):
         if self.udsm == 3 and previousState != 3:
             self.changeMode(100) # menu
 
-    def buttonCustom(self, action, up):
-        if action==0x40000001:
-            self.upDownStateMachine(1, up)
-        elif action==0x40000002:
-            self.upDownStateMachine(2, up)
-        else:
-            self.log('Unhandled custom button action %08x'%action)
+    # Custom controls: the up/down arrow buttons drive the state machine above
+    @customControl(8, 0x40000001)
+    def onUpArrowDown(self, action):
+        self.upDownStateMachine(1, False)
 
-    def encoderCustom(self, param, incr=None, reset=False):
-        if action==0x40000003:
-            # Acknowledge, but otherwise ignore
-            self.sendTangent(u4(0x82) + u4(action) + encf(0.5) + u4(0))
-        else:
-            self.log('Unhandled custom encoder action %08x'%action)
+    @customControl(0xb, 0x40000001)
+    def onUpArrowUp(self, action):
+        self.upDownStateMachine(1, True)
+
+    @customControl(8, 0x40000002)
+    def onDownArrowDown(self, action):
+        self.upDownStateMachine(2, False)
+
+    @customControl(0xb, 0x40000002)
+    def onDownArrowUp(self, action):
+        self.upDownStateMachine(2, True)
+
+    @customControl(2, 0x40000003)
+    @customControl(3, 0x40000003)
+    @customControl(4, 0x40000003)
+    def onCustomEncoder(self, param, *fields):
+        # Acknowledge, but otherwise ignore
+        self.sendFrame(paramValueFrame(param, 0.5))
 
     # -----------------------------------------------------------------
     # MIDI2LR logic
 
     def runLRSendQ(self):
-        if not self.lrSendInProgress:
-            try:
-                item = self.lrQueue.get(False)
-                self.lrSendInProgress = True
-                if PYTHON3:
-                    item = bytes(item,'utf-8')
-                self.LRSend.sendall(item)
-            except Queue.Empty:
-                pass
-
-    def sendLR(self, param, value):
-        msg="%s %s\n"%(param,value)
-        if PYTHON3:
-            msg = bytes(msg, 'utf-8')
-        self.LRSend.sendall(msg)
+        '''
+        Sends LR waiting messages, as long as there is room in the window of unacknowledged ones.
+        The priority scheduler says which class goes next; reads are batched.
+        The rate controller paces them so LR doesn't fall further behind than it has to.
+        '''
+        if self.outBuffers.get(self.LRSend) is None:
+            return # LR is away
+        while not self.lrAcked or len(self.lrInFlight) < self.lrWindow:
+            cls = self.lrScheduler.choose(READS_HELD if self.readsInFlight >= self.maxReads else ())
+            if cls is None:
+                break
+            if not self.rate.take():
+                if self.rateTimer is None:
+                    self.rateTimer = self.callLater(self.rate.delay(), self.rateReady)
+                break
+            if cls == LR_ACTIONS:
+                label, msg = self.lrActions.popleft()
+            elif cls == LR_WRITES:
+                entry = self.lrWrites.popleft()
+                label, msg = entry
+                if self.lrWriteEntries.get(label) is entry:
+                    del self.lrWriteEntries[label]
+            else:
+                label, msg = self.nextRead()
+                if self.lrAcked:
+                    self.readsInFlight += 1
+            self.lrScheduler.served(cls)
+            self.send(self.LRSend, msg)
+            if self.lrAcked:
+                self.lrInFlight.append((label, monotonic()))
+            else:
+                self.lrOwed += 1
+        if self.lrInFlight and self.ackTimer is None:
+            self.ackTimer = self.callLater(ACK_TIMEOUT, self.checkAcks)
 
-    def sendLRQueued(self, param, value):
-        # LR can't cope with too many messages at once, so queue them
-        self.lrQueue.put("%s %s\n"%(param,value))
+    def rateReady(self):
+        self.rateTimer = None
+        self.runLRSendQ()
+
+    def nextRead(self):
+        ''' Takes reads off the queue. Returns (label, message). '''
+        if self.lrProtocol is None or len(self.lrQueue) == 1:
+            # Plain MIDI2LR has no batch read
+            name, mode = self.lrQueue.popleft()
+            self.lrReading[name] = (mode, monotonic())
+            return 'GetValue', lrMessage('GetValue', name)
+        names = []
+        while self.lrQueue and len(names) < READ_BATCH:
+            name, mode = self.lrQueue.popleft()
+            self.lrReading[name] = (mode, monotonic())
+            names.append(name)
+        return 'GetValues', lrListMessage('GetValues', names)
+
+    def reading(self, name):
+        ''' Says whether a read of name for the current mode has recently gone to LR, and not been answered '''
+        mode, sent = self.lrReading.get(name, (None, None))
+        return mode == self.modeId and monotonic() - sent < READ_TIMEOUT
+
+    def staleReply(self, name):
+        '''
+        Checks off a value from LR against the reads we sent. Returns True if it answers a read from an earlier mode
+        for a parameter the panel is no longer showing, which should update our copy but not go to the Hub.
+        '''
+        mode, sent = self.lrReading.pop(name, (None, None))
+        if mode is None or mode == self.modeId or name in self.visibleParams:
+            return False
+        self.lateReplies += 1
+        return True
+
+    def checkAcks(self):
+        '''
+        Makes sure the oldest message in flight hasn't gone unacknowledged for too long.
+        If LR has been acknowledging, it is just slow (a long Auto Tone, a dialog box): we stop waiting for
+        the late messages, but expect their acks to turn up eventually. Otherwise we take it LR doesn't ack
+        at all, and send without waiting until an ack says otherwise.
+        '''
+        self.ackTimer = None
+        if not self.lrInFlight:
+            return
+        label, sent = self.lrInFlight[0]
+        age = monotonic() - sent
+        if age < ACK_TIMEOUT:
+            self.ackTimer = self.callLater(ACK_TIMEOUT - age, self.checkAcks)
+            return
+        now = monotonic()
+        expired = 0
+        # Nor can we count on answers to the reads we've sent
+        self.lrReading.clear()
+        while self.lrInFlight and (not self.lrAckSeen or now - self.lrInFlight[0][1] >= ACK_TIMEOUT):
+            self.forget(self.lrInFlight.popleft()[0])
+            expired += 1
+        self.lrOwed += expired
+        if self.lrAckSeen:
+            self.log('!!! No ack from LR for %s in %.1f s; not waiting for %d messages' % (label, age, expired))
+        else:
+            self.log('!!! No ack from LR for %s in %.1f s; sending without waiting for acks' % (label, age))
+            self.lrAcked = False
+        self.runLRSendQ()
+
+    def forget(self, label):
+        ''' Stops waiting for the ack of a message in flight '''
+        if label in READ_LABELS:
+            self.readsInFlight -= 1
+        elif label == SHUTTLE_LABEL:
+            self.shuttle.stepped()
+
+    def acked(self, n):
+        ''' LR has acknowledged the oldest n messages in flight '''
+        now = monotonic()
+        self.lrAckSeen = True
+        if not self.lrAcked:
+            self.log('LR is acknowledging messages again')
+            self.lrAcked = True
+        # The first acks are for messages we stopped waiting for
+        owed = min(n, self.lrOwed)
+        self.lrOwed -= owed
+        n -= owed
+        for i in range(min(n, len(self.lrInFlight))):
+            label, sent = self.lrInFlight.popleft()
+            self.forget(label)
+            rtt = now - sent
+            t = self.lrRtt.get(label)
+            if t is None:
+                t = self.lrRtt[label] = Timing('LR round trip: ' + label, 'acks')
+            t.record(rtt)
+            self.lrSrtt = rtt if self.lrSrtt is None else 0.875 * self.lrSrtt + 0.125 * rtt
+            self.rate.observe(rtt)
+        self.runLRSendQ()
+
+    def sendLR(self, param, value, label=None):
+        '''
+        Queues a message for LR. label, for an action, is what it is known by in lrInFlight, if not param.
+        A parameter value (a float) is a write; anything else is an action. Actions wait for the writes
+        queued before them, except INDEPENDENT_ACTIONS, which go first.
+        A write replaces any earlier value for the same parameter still waiting to go,
+        so when LR falls behind it is sent only the latest.
+        '''
+        if invalidates(param):
+            self.cache.invalidate()
+            self.localEdits.clear()
+        if not isinstance(value, float) and param not in INDEPENDENT_ACTIONS:
+            # Changes still in the coalescer were made first, so go first, as do those already queued
+            self.coalescer.flush()
+            self.lrActions.extend(self.lrWrites)
+            self.lrWrites.clear()
+            self.lrWriteEntries.clear()
+        id = COMPACT_IDS.get(param) if self.lrCompact else None
+        msg = lrMessage(param, value) if id is None else compactMessage(id, value)
+        if not isinstance(value, float):
+            self.lrActions.append([label or param, msg])
+        elif param in self.lrWriteEntries:
+            self.lrWriteEntries[param][1] = msg
+            self.lrSuperseded += 1
+            return
+        else:
+            entry = self.lrWriteEntries[param] = [param, msg]
+            self.lrWrites.append(entry)
+        self.runLRSendQ()
+
+    def dropWrite(self, name):
+        ''' Forgets any write for a parameter still waiting to go to LR '''
+        entry = self.lrWriteEntries.pop(name, None)
+        if entry is not None:
+            self.lrWrites.remove(entry)
+
+    def readLR(self, name):
+        ''' Asks LR for a parameter's value. The reply is passed on to the Hub (as 0x82 or 0xa6) when it comes. '''
+        # LR can't cope with too many messages at once, so queue them.
+        # They come in bursts (a mode's worth at a time), so let the burst finish and send them together.
+        self.lrQueue.add(name, self.modeId)
+        if self.readTimer is None:
+            self.readTimer = self.callLater(0, self.readsReady)
+
+    def readsReady(self):
+        self.readTimer = None
         self.runLRSendQ()
 
     def handleLR(self, message):
         ''' Deal with a single Midi2LR request '''
         #self.log('<<< %s'%message)
+        if message[:1] == b'#':
+            id, value = readCompact(message)
+            if id not in Control.by_id:
+                self.log('!!! Received compact message for unknown control %x'%id)
+                return
+            name = Control.name_for(id)
+            if not self.localEdits.reported(name, value):
+                self.staleReply(name)
+                self.log('<<< PARAM: %s -> %s (panel is ahead)'%(name,value))
+                return
+            VALUES[id] = value
+            self.cache.put(name, value)
+            if self.staleReply(name):
+                self.log('<<< PARAM: %s -> %s (late, not passed on)'%(name,value))
+                return
+            self.log('<<< PARAM: %s -> %s (->Tangent)'%(name,value))
+            self.sendFrame(paramValueFrame(id, value))
+            return
         command,value = message.split(b' ',1)
         if PYTHON3:
-             command = command.decode('ascii')
+            command = command.decode('ascii')
         if value == b'':
             value = None
         else:
             value=float(value)
-        if value is None and command != b'TerminateApplication':
+        if value is None and command != 'TerminateApplication':
             self.log('Received message without value: %s'%command)
-        elif command == b'SwitchProfile':
+        elif command == 'SwitchProfile':
             # WRITEME
             self.log('<<< SWITCH PROFILE %s (ignored)'%value)
-        elif command == b'TerminateApplication':
+        elif command == 'TerminateApplication':
             self.log('<<< TERMINATE (bye!)')
             self.halt = True
-        elif command == b'Log':
+        elif command == 'Protocol':
+            self.lrProtocol = int(value)
+            self.lrCompact = self.offerCompact and value >= PROTOCOL_COMPACT
+            self.lrTracking = value >= PROTOCOL_TRACKING
+            self.log('<<< PROTOCOL %d: %s encoding, batched reads%s%s'%(value, 'compact' if self.lrCompact else 'text',
+                    ', tracking' if self.lrTracking else '', ', photo notices' if value >= PROTOCOL_PHOTOS else ''))
+        elif command == 'PhotoChanged':
+            self.log('<<< PHOTO CHANGED')
+            self.cache.invalidate()
+            self.localEdits.clear()
+        elif command == 'Log':
             self.log('<<< LOG: %s'%value)
-        elif command == b'SendKey':
+        elif command == 'SendKey':
             self.log('<<< SENDKEY %s (ignored)'%value)
             # TODO: This is used to send fake keystrokes to the app
+        elif not self.localEdits.reported(command, value):
+            self.staleReply(command)
+            self.log('<<< PARAM: %s -> %s (panel is ahead)'%(command,value))
         else:
-            self.log('<<< PARAM: %s -> %s (->Tangent)'%(command,value))
+            self.cache.put(command, value)
+            stale = self.staleReply(command)
+            self.log('<<< PARAM: %s -> %s %s'%(command,value,'(late, not passed on)' if stale else '(->Tangent)'))
             try:
                 id = Control.id_for(command) # may fail with KeyError
-                VALUES[id] = float(value)
-                self.sendTangent(u4(0x82) + u4(id) + encf(VALUES[id]) + u4(0))
+                VALUES[id] = value
+                if not stale:
+                    self.sendFrame(paramValueFrame(id, value))
                 # Caution! MIDI2LR uses values 0..1 ... midi2lr has a xlation layer, need to play nicely with that. This is a job for the XML.
             except KeyError:
                 # Assume it's a custom param
-                VALUES[command] = float(value)
-                self.sendTangent(u4(0xa6) + encstr(command) + encf(float(value)) + u4(0))
+                p = CustomParam.get(command)
+                CUSTOM_VALUES[p.slot] = value
+                if not stale:
+                    self.sendFrame(customParamValueFrame(p.template, value))
+
+    def lrCorrected(self, name, value):
+        ''' LR never came round to a value the Hub was shown ahead of it, so show the Hub LR's instead '''
+        self.log('<<< PARAM: %s -> %s (correcting the panel)'%(name,value))
+        self.cache.put(name, value)
+        try:
+            id = Control.id_for(name) # may fail with KeyError
+            VALUES[id] = value
+            self.sendFrame(paramValueFrame(id, value))
+        except KeyError:
+            p = CustomParam.get(name)
+            CUSTOM_VALUES[p.slot] = value
+            self.sendFrame(customParamValueFrame(p.template, value))
 
     def inboundLR(self):
-        ''' Process inbound data from MIDI2LR '''
-        msg = None
+        ''' Process inbound data from MIDI2LR. Handles every complete line that has arrived. '''
+        buf = self.lrIn
         try:
-            msg = self.LRRecv.recv(4096)
+            buf.fill(self.LRRecv)
         except socket.error as e:
-            self.log('LR inbound socket closed (%s); bailing' % e)
-            self.halt = True
+            self.linkDown('LRRecv', e)
             return
+        if buf.highWater > self.lrInHighWater:
+            self.lrInHighWater = buf.highWater
+            self.log('LR inbound buffer high-water mark now %d bytes' % buf.highWater)
         # commands are strings, terminated with \n
-        packets = msg.split(b'\n')
-        for p in packets:
+        for p in buf.lines():
             if len(p):
                 self.handleLR(p)
-        self.lrSendInProgress = False
-        self.runLRSendQ()
+        if buf.closed:
+            self.linkDown('LRRecv', 'closed by peer')
+
+    def inboundLRAck(self):
+        ''' Process inbound data on the LR send socket. This is an 'ok' for each command, which we count. '''
+        n = 0
+        try:
+            while True:
+                data = self.LRSend.recv(4096)
+                if not data:
+                    self.linkDown('LRSend', 'closed by peer')
+                    return
+                # An 'ok' may be split across reads
+                data = self.ackTail + data
+                n += data.count(b'ok')
+                self.ackTail = b'o' if data.endswith(b'o') else b''
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.linkDown('LRSend', e)
+                return
+        if n:
+            self.acked(n)
 
     # -----------------------------------------------------------------
 
     def run(self):
         ''' Main loop, runs until termination command received '''
-        tangent = self.Tangent.fileno()
-        lrrx = self.LRRecv.fileno()
-        lrtx = self.LRSend.fileno()
-        self.halt = False
         while not self.halt:
-            socketList = [ tangent, lrtx, lrrx ]
-            rlist,_,_ = select.select( socketList, [], [] )
-            if tangent in rlist:
-                self.inboundTangent()
-            if lrrx in rlist:
-                self.inboundLR()
-            if lrtx in rlist:
-                # this is an 'ok' for each command, which we just sink
-                _ = self.LRSend.recv(128)
+            self.runOnce()
+        self.logStats()
+
+    def logStats(self):
+        for line in self.commandStats():
+            self.log('Stats: ' + line)
+        self.log('Stats: parameter updates to LR: ' + self.coalescer.stats())
+        self.log('Stats: transport ring: ' + self.jog.stats())
+        self.log('Stats: shuttle: ' + self.shuttle.stats())
+        self.log('Stats: dial turns: ' + self.gestures.stats())
+        self.log('Stats: panel reads: ' + self.cache.stats())
+        self.log('Stats: panel display: ' + self.localEdits.stats())
+        self.log('Stats: LR pacing: %s; %d waiting updates superseded' % (self.rate.stats(), self.lrSuperseded))
+        for line in self.lrScheduler.stats():
+            self.log('Stats: LR queue ' + line)
+        self.log('Stats: reads: %s; cancelled by mode changes %d, late answers not passed on %d' % (
+                self.lrQueue.stats(), self.readsCancelled, self.lateReplies))
+        rtts = sorted(self.lrRtt.values(), key=lambda t: -t.count)
+        for t in rtts[:10]:
+            self.log('Stats: ' + t.stats())
+
+    def runOnce(self, maxWait=None):
+        '''
+        One pass of the event loop: fires due timers, flushes output, then waits up to maxWait seconds
+        (or until the next timer, if sooner) for input, and handles it.
+        '''
+        timeout = self.runTimers()
+        if maxWait is not None and (timeout is None or maxWait < timeout):
+            timeout = maxWait
+        # One flush per pass, covering everything the last batch of input and the timers produced
+        self.flushAll()
+        if self.halt:
+            return
+        socketList = [ s for s in (self.Tangent, self.LRSend, self.LRRecv) if s is not None ]
+        # Only watch for writability while there is something waiting to go out
+        wlist = self.writePending()
+        if not socketList and not wlist:
+            # Everything is down and awaiting reconnection (Windows won't select on nothing)
+            time.sleep(timeout or RECONNECT_MIN)
+            return
+        rlist,wlist = self.transport.wait( socketList, wlist, timeout )
+        if wlist:
+            self.flushAll()
+            self.runLRSendQ()
+        if self.Tangent in rlist:
+            self.inboundTangent()
+        if self.LRRecv in rlist:
+            self.inboundLR()
+        if self.LRSend in rlist:
+            self.inboundLRAck()
 
 if __name__ == '__main__':
-    # First argument is the path to the plugin Info.lua, which must be in the same dir as the XML files. If not given, it's assumed to be the directory this file lives in.
-    bridge = Bridge(sys.argv[0])
+    parser = argparse.ArgumentParser(description='Bridge between the Tangent Hub and the Lightroom plugin')
+    parser.add_argument('--engine', choices=ENGINES, default='select',
+            help='event engine to run on (asyncio needs Python 3)')
+    parser.add_argument('--text', action='store_true',
+            help="always use the plugin's text protocol, rather than offering the compact encoding")
+    parser.add_argument('--coalesce', type=float, default=1000*COALESCE_WINDOW, metavar='MS',
+            help='merge encoder updates to a parameter within this many milliseconds (0 to send them all)')
+    parser.add_argument('--jog', type=float, default=1000*JOG_WINDOW, metavar='MS',
+            help='add up transport ring steps for this many milliseconds before moving (0 to move at once)')
+    parser.add_argument('--shuttle', type=float, default=SHUTTLE_RATE, metavar='RATE',
+            help='photos a second to step for each unit the shuttle ring is turned (0 to ignore the shuttle)')
+    parser.add_argument('--gesture', type=float, default=1000*GESTURE_IDLE, metavar='MS',
+            help='how long a dial must be left alone to finish one step in Lightroom\'s history; 0 to leave it to Lightroom')
+    parser.add_argument('--cache', type=float, default=1000*CACHE_MAX_AGE, metavar='MS',
+            help='answer the panel from values Lightroom sent up to this long ago (0 to always ask Lightroom)')
+    parser.add_argument('--echo', type=float, default=1000*ECHO_SETTLE, metavar='MS',
+            help='show the panel its changes at once, and give Lightroom this long to agree; 0 to wait for Lightroom')
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false',
+            help='don\'t send the panel a mode\'s values until it asks for them')
+    parser.add_argument('--window', type=int, default=LR_WINDOW, metavar='N',
+            help='most messages to have in flight to Lightroom, awaiting acknowledgement')
+    parser.add_argument('--reads', type=int, default=READS_IN_FLIGHT, metavar='N',
+            help='most of those messages which may be reads')
+    parser.add_argument('--latency', type=float, default=1000*TARGET_LATENCY, metavar='MS',
+            help='round trip time to Lightroom to pace messages for; 0 to send as fast as it acknowledges')
+    args = parser.parse_args()
+    options = dict(compact=not args.text, coalesce=args.coalesce/1000.0, jog=args.jog/1000.0, window=args.window,
+            latency=args.latency/1000.0, reads=args.reads, gesture=args.gesture/1000.0,
+            shuttle=args.shuttle, cache=args.cache/1000.0, prefetch=args.prefetch,
+            echo=args.echo/1000.0)
+    # The plugin path is taken to be that of this file, which must be in the same dir as the XML files.
+    if args.engine == 'asyncio':
+        from TangentAsyncio import AsyncioBridge
+        bridge = AsyncioBridge(sys.argv[0], **options)
+    else:
+        bridge = Bridge(sys.argv[0], **options)
     bridge.run()
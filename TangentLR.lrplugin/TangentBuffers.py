@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Written to work on both Python 2 and 3
+
+# Send and receive buffers for the bridge's sockets.
+#
+# Each receive buffer is a single bytearray which is reused for the life of the connection.
+# A fill() reads everything the socket has to offer in one go, then complete messages
+# are handed out as memoryview slices of the buffer, so nothing is copied per message.
+#
+# Send buffers gather everything written while handling one batch of input,
+# then write it out with as few system calls as possible.
+
+import errno
+import socket
+import struct
+
+# Most systems limit a scatter-gather write to 1024 chunks
+IOV_MAX = 1024
+
+class FramingError(ValueError):
+    ''' The stream no longer makes sense as Tangent packets; only a new connection will put it right '''
+
+class RecvBuffer(object):
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first byte not yet consumed
+        self.end = 0 # end of valid data
+        self.closed = False # peer has closed the connection
+        self.highWater = 0 # most data we have ever held at once
+
+    def __len__(self):
+        return self.end - self.start
+
+    def makeRoom(self):
+        ''' Moves unconsumed data to the front of the buffer, growing it if it is full '''
+        pending = self.end - self.start
+        if self.start == 0:
+            # Completely full of a single partial message; grow.
+            # Any views handed out earlier are invalid by now, so we can safely replace the buffer.
+            newbuf = bytearray(2 * len(self.buf))
+            newbuf[0:pending] = self.buf[0:pending]
+            self.buf = newbuf
+            self.view = memoryview(newbuf)
+        else:
+            self.buf[0:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def fill(self, sock):
+        '''
+        Reads everything currently available from a non-blocking socket.
+        Returns the number of bytes read. If the peer closed, sets self.closed.
+        '''
+        total = 0
+        while True:
+            if self.end == len(self.buf):
+                self.makeRoom()
+            try:
+                n = sock.recv_into(self.view[self.end:])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if n == 0:
+                self.closed = True
+                break
+            self.end += n
+            total += n
+        if self.end - self.start > self.highWater:
+            self.highWater = self.end - self.start
+        return total
+
+class FrameBuffer(RecvBuffer):
+    ''' Reassembles length-prefixed Tangent packets '''
+    def frames(self):
+        '''
+        Yields every complete packet in the buffer, without its length word.
+        Each packet is a memoryview which is only valid until the next fill().
+        '''
+        while self.end - self.start >= 4:
+            dlen = struct.unpack_from('>i', self.buf, self.start)[0]
+            if dlen < 0:
+                raise FramingError('bad Tangent packet length %d' % dlen)
+            pos = self.start + 4
+            if self.end - pos < dlen:
+                break # incomplete; wait for more
+            self.start = pos + dlen
+            yield self.view[pos:self.start]
+        if self.start == self.end:
+            self.start = self.end = 0
+
+class LineBuffer(RecvBuffer):
+    ''' Reassembles newline-terminated MIDI2LR messages '''
+    def lines(self):
+        '''
+        Yields every complete line in the buffer, without its terminator.
+        A trailing partial line is kept until the rest of it arrives.
+        '''
+        buf = self.buf
+        while True:
+            nl = buf.find(b'\n', self.start, self.end)
+            if nl < 0:
+                break
+            line = self.view[self.start:nl].tobytes()
+            self.start = nl + 1
+            yield line
+        if self.start == self.end:
+            self.start = self.end = 0
+
+class SendBuffer(object):
+    def __init__(self, limit=256*1024):
+        self.chunks = []
+        self.pending = 0 # bytes queued
+        self.limit = limit # most bytes we will queue; past this, messages are dropped
+        self.messages = 0 # messages queued, ever
+        self.dropped = 0 # messages refused because we were full, ever
+        self.syscalls = 0 # send calls made, ever
+
+    def __len__(self):
+        return self.pending
+
+    def write(self, *chunks):
+        '''
+        Queues a message, which may be made up of several chunks.
+        Returns False if the buffer is full, in which case the whole message is dropped.
+        '''
+        size = 0
+        for c in chunks:
+            size += len(c)
+        if self.pending + size > self.limit:
+            self.dropped += 1
+            return False
+        self.chunks.extend(chunks)
+        self.pending += size
+        self.messages += 1
+        return True
+
+    def flush(self, sock):
+        '''
+        Writes as much as a non-blocking socket will take, using scatter-gather sends where the platform has them.
+        Anything the socket won't take stays queued for the next call.
+        Returns True if the buffer is now empty.
+        '''
+        while self.chunks:
+            batch = self.chunks[:IOV_MAX]
+            self.syscalls += 1
+            try:
+                if hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(batch)
+                else: # Python 2, Windows
+                    sent = sock.send(bytearray().join(batch))
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            full = sent < sum(len(c) for c in batch)
+            self.consume(sent)
+            if full:
+                return False
+        return True
+
+    def consume(self, n):
+        ''' Discards the first n bytes queued, which have been written '''
+        self.pending -= n
+        i = 0
+        while n:
+            c = self.chunks[i]
+            if len(c) > n:
+                self.chunks[i] = c[n:]
+                break
+            n -= len(c)
+            i += 1
+        del self.chunks[:i]
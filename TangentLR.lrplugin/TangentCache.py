@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Written to work on both Python 2 and 3
+
+# What we know of Lightroom's parameter values, and how far to trust it.
+#
+# Lightroom tells the bridge whenever a parameter changes, so most of the time the value it last sent
+# is still right and the panel can be answered without asking again. Each entry is stamped with the
+# generation it belongs to and when it arrived. Moving to another photo starts a new generation,
+# which makes everything stale at a stroke; otherwise entries go stale with age, in case a change
+# notice went missing.
+#
+# Going the other way, the panel is shown its own changes straight away, ahead of Lightroom. LocalEdits
+# keeps those values until Lightroom has caught up with them.
+
+import time
+
+# time.monotonic is Python 3 only
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Default time (seconds) an entry is trusted for
+CACHE_MAX_AGE = 5.0
+
+# How far (in Lightroom's 0..1 units) its value may be from one the panel was shown and still agree with it
+ECHO_TOLERANCE = 0.005
+# Default time (seconds) Lightroom is given after the last local change to catch up with it
+ECHO_SETTLE = 1.0
+
+class ParamCache(object):
+    def __init__(self, maxAge=CACHE_MAX_AGE, clock=monotonic):
+        self.maxAge = maxAge
+        self.clock = clock
+        self.generation = 0
+        self.entries = {} # key (parameter name) -> (value, generation, time)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def put(self, key, value):
+        self.entries[key] = (value, self.generation, self.clock())
+
+    def get(self, key):
+        ''' Returns the value for key if it is still fresh, otherwise None '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, generation, when = entry
+            if generation == self.generation and self.clock() - when < self.maxAge:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def invalidate(self):
+        ''' Makes every entry stale, e.g. because Lightroom has moved to another photo '''
+        self.generation += 1
+        self.invalidations += 1
+
+    def stats(self):
+        return '%d answered from cache, %d read from Lightroom, invalidated %d times' % (
+                self.hits, self.misses, self.invalidations)
+
+class LocalEdits(object):
+    '''
+    Values the panel has been shown ahead of Lightroom, keyed by parameter name.
+    Values Lightroom reports for such a parameter are checked against the one shown: a value within the tolerance
+    confirms it. Anything else is taken to be Lightroom catching up with an earlier change, until it has had the
+    settle time since the last one; if by then it still doesn't agree, correct(key, value) is called with the last
+    value it reported. If it has reported nothing (the plugin doesn't echo the values we set, and may have dropped
+    one), reread(key) is called to ask it. A settle time of 0 turns this off, and the panel waits for Lightroom.
+    '''
+    def __init__(self, callLater, correct, reread, tolerance=ECHO_TOLERANCE, settle=ECHO_SETTLE, clock=monotonic):
+        self.callLater = callLater
+        self.correct = correct
+        self.reread = reread
+        self.tolerance = tolerance
+        self.settle = settle
+        self.clock = clock
+        self.entries = {} # key -> [value shown, time shown, latest value from Lightroom or None]
+        self.timers = {} # key -> timer to check whether Lightroom has caught up
+        self.shown = 0
+        self.confirmed = 0
+        self.corrected = 0
+        self.rereads = 0
+
+    def enabled(self):
+        return self.settle > 0
+
+    def show(self, key, value):
+        ''' The panel has been shown value for key '''
+        self.shown += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [value, self.clock(), None]
+            self.timers[key] = self.callLater(self.settle, self.check, key)
+        else:
+            entry[0] = value
+            entry[1] = self.clock()
+
+    def reported(self, key, value):
+        ''' Lightroom has reported value for key. Returns True if it should go to the panel. '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return True
+        if abs(value - entry[0]) <= self.tolerance:
+            self.confirmed += 1
+            self.discard(key)
+        else:
+            entry[2] = value
+        return False
+
+    def discard(self, key):
+        ''' Forgets the value shown for key, e.g. because it has been reset '''
+        if key in self.entries:
+            del self.entries[key]
+            self.timers.pop(key).cancel()
+
+    def check(self, key):
+        shown, when, reported = self.entries[key]
+        remaining = self.settle - (self.clock() - when)
+        if remaining > 0:
+            # As in GestureTracker, wait out the remainder rather than reset the timer on every change
+            self.timers[key] = self.callLater(remaining, self.check, key)
+            return
+        del self.entries[key]
+        del self.timers[key]
+        if reported is not None:
+            self.corrected += 1
+            self.correct(key, reported)
+        else:
+            self.rereads += 1
+            self.reread(key)
+
+    def clear(self):
+        ''' Forgets every value, e.g. because Lightroom has gone away '''
+        for t in self.timers.values():
+            t.cancel()
+        self.entries = {}
+        self.timers = {}
+
+    def stats(self):
+        return '%d values shown ahead of Lightroom; it confirmed %d, corrected %d, was asked again for %d' % (
+                self.shown, self.confirmed, self.corrected, self.rereads)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Written to work on both Python 2 and 3
+
+# Encoding and decoding for the bridge's two wire protocols.
+#
+# Tangent packets are big-endian words, length-prefixed. The struct formats are compiled once, here,
+# and the packets we send most often are packed in one call, length word and all ("frames").
+# Strings which never change (the app name, menu display names, parameter names) are encoded once and cached.
+#
+# MIDI2LR messages are "name value\n" text. The "name " prefix of each is cached as bytes,
+# and floats are sent at a fixed precision rather than as Python's shortest round-trip repr.
+
+import struct
+import sys
+
+PYTHON3 = sys.version_info[0] >= 3
+
+INT = struct.Struct('>i')
+FLOAT = struct.Struct('>f')
+INT_INT = struct.Struct('>ii')
+INT_FLOAT = struct.Struct('>if')
+FLOAT_INT = struct.Struct('>fi')
+# length, 0x82, id, value, 0
+PARAM_VALUE = struct.Struct('>iiifi')
+# length, 0x85, mode
+MODE_CHANGE = struct.Struct('>iii')
+
+# Precision of floats sent to MIDI2LR, whose values mostly run 0..1
+LR_FLOAT_FORMAT = '%.6f\n'
+
+# Versions of our extensions to the MIDI2LR protocol, which the bridge offers the plugin at connect time
+# ("Protocol N") and the plugin accepts by replying with the version it will speak.
+# A plugin which replies at all understands batched reads (GetValues) and StepPhotos.
+PROTOCOL_TEXT = 1
+PROTOCOL_COMPACT = 2
+# ...and StartTracking/StopTracking, which make each turn of a dial one step in Lightroom's history
+PROTOCOL_TRACKING = 3
+# ...and PhotoChanged, which the plugin sends when Lightroom moves to another photo
+PROTOCOL_PHOTOS = 4
+# The bridge offers its latest version. "Protocol N text" offers everything but the compact encoding,
+# for when the traffic needs to be readable; the plugin's reply is the same either way.
+TEXT_ONLY = 'text'
+
+# The compact encoding (PROTOCOL_COMPACT).
+# Each message is '#', the value (0..1) scaled to COMPACT_SCALE as six hex digits, then the control id in hex.
+# LrSocket delivers messages a line at a time, so these are still newline-terminated text.
+COMPACT_SCALE = 0xffffff
+
+# Readers. These work in place on bytes, bytearrays or memoryviews.
+def rd4(seq, pos=0):
+    return INT.unpack_from(seq, pos)[0]
+def rd4f(seq, pos=0):
+    return FLOAT.unpack_from(seq, pos)[0]
+def rd4multi(seq, pos, n):
+    if n == 2:
+        return INT_INT.unpack_from(seq, pos)
+    return struct.unpack_from('>%di' % n, seq, pos)
+def tobytes(seq):
+    ''' Copies a sequence (which may be a memoryview) into a bytes object '''
+    if isinstance(seq, memoryview):
+        return seq.tobytes()
+    return bytes(seq)
+def rdstr(seq, pos):
+    # returns (string, how far to advance the stream)
+    length = rd4(seq, pos)
+    return tobytes(seq[pos+4:pos+4+length]), 4+length
+
+# Field parsers for Tangent commands: each takes a whole packet and returns the fields after the command word
+def noFields(pkt):
+    return ()
+def oneInt(pkt):
+    return INT.unpack_from(pkt, 4)
+def twoInts(pkt):
+    return INT_INT.unpack_from(pkt, 4)
+def intFloat(pkt):
+    return INT_FLOAT.unpack_from(pkt, 4)
+def oneStr(pkt):
+    return (rdstr(pkt, 4)[0],)
+def strFloat(pkt):
+    name, offset = rdstr(pkt, 4)
+    return name, rd4f(pkt, 4+offset)
+
+# Writers
+def u4(i):
+    return INT.pack(i)
+def encf(f):
+    return FLOAT.pack(f)
+def tobin(s):
+    ''' Text as UTF-8 bytes; bytes are passed through '''
+    if PYTHON3 and isinstance(s, str):
+        return s.encode('utf-8')
+    if not PYTHON3 and isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+def encstr(s):
+    s = tobin(s)
+    return INT.pack(len(s)) + s
+
+_strings = {}
+def encconst(s):
+    ''' encstr for strings which are used over and over, such as names '''
+    enc = _strings.get(s)
+    if enc is None:
+        enc = _strings[s] = encstr(s)
+    return enc
+
+# Whole Tangent frames, ready for the wire
+def frame(pkt):
+    ''' Prepends the length word to a packet '''
+    return INT.pack(len(pkt)) + pkt
+
+def paramValueFrame(id, value):
+    ''' 0x82 ParameterValue '''
+    return PARAM_VALUE.pack(16, 0x82, id, value, 0)
+
+def modeChangeFrame(mode):
+    ''' 0x85 ModeValue '''
+    return MODE_CHANGE.pack(8, 0x85, mode)
+
+_menuFrames = {}
+def menuStringFrame(id, display):
+    ''' 0x83 MenuString. There are only so many menu items, so each frame is built once. '''
+    key = (id, display)
+    f = _menuFrames.get(key)
+    if f is None:
+        f = _menuFrames[key] = frame(u4(0x83) + u4(id) + encconst(display) + u4(0))
+    return f
+
+def customParamTemplate(name):
+    ''' A 0xa6 CustomParameterValue frame for the named parameter, with room for the value; see customParamValueFrame '''
+    body = u4(0xa6) + encstr(name) + bytearray(FLOAT_INT.size)
+    return bytes(frame(body))
+
+def customParamValueFrame(template, value):
+    ''' 0xa6 CustomParameterValue: packs the value into a copy of the parameter's template '''
+    pkt = bytearray(template)
+    FLOAT_INT.pack_into(pkt, len(pkt) - FLOAT_INT.size, value, 0)
+    return pkt
+
+# MIDI2LR messages
+_lrPrefixes = {}
+def lrPrefix(param):
+    p = _lrPrefixes.get(param)
+    if p is None:
+        p = _lrPrefixes[param] = tobin(param) + b' '
+    return p
+
+_lrMessages = {}
+def lrMessage(param, value):
+    ''' Encodes "param value\\n". Floats are formatted at fixed precision; anything else is a constant and cached whole. '''
+    if isinstance(value, float):
+        return lrPrefix(param) + (LR_FLOAT_FORMAT % value).encode('ascii')
+    key = (param, value)
+    m = _lrMessages.get(key)
+    if m is None:
+        if not isinstance(value, bytes):
+            value = '%s' % (value,)
+        m = _lrMessages[key] = lrPrefix(param) + tobin(value) + b'\n'
+    return m
+
+def lrListMessage(param, names):
+    ''' Encodes "param name1 name2 ...\n" '''
+    return lrPrefix(param) + b' '.join([ tobin(n) for n in names ]) + b'\n'
+
+_compactMessages = {}
+def compactMessage(id, value):
+    ''' Encodes a message for control id in the compact encoding; the value is clamped to 0..1 '''
+    if isinstance(value, float):
+        v = int(min(max(value, 0.0), 1.0) * COMPACT_SCALE + 0.5)
+        return ('#%06x%x\n' % (v, id)).encode('ascii')
+    key = (id, value)
+    m = _compactMessages.get(key)
+    if m is None:
+        m = _compactMessages[key] = compactMessage(id, float(value))
+    return m
+
+def readCompact(line):
+    ''' Decodes a compact message (without its newline). Returns (id, value). '''
+    return int(line[7:], 16), int(line[1:7], 16) / float(COMPACT_SCALE)
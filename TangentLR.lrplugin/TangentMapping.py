@@ -7,6 +7,7 @@ import abc
 #   Objects to make it easier to specify control mappings
 #   The list of all controls that we support (--> controls.xml)
 #   The notion of "default" controls that are shared across all banks
+#   Macros: actions which TangentBridge carries out as a series of other actions
 #   A default mapping for the Wave (--> wave-map.xml)
 #     (other panels could be added later)
 
@@ -131,6 +132,27 @@ class Parameter(XMLable):
     def __str__(self):
         return 'Parameter: %s'%self.Name
 
+# all macros, indexed by ID, for TangentBridge to look up
+ALL_MACROS = {}
+
+class Macro(Action):
+    # To the Hub this is just another action. TangentBridge sends its steps to MIDI2LR in turn.
+    # steps is a list of MIDI2LR verbs, e.g. ['Pick', 'Next']; 'Pause' waits a moment, as in MIDI2LR's action series.
+    def __init__(self, id, name, steps, panel=None, name9=None, name14=None, name20=None):
+        super(Macro, self).__init__(id, name, panel, name9, name14, name20)
+        self.steps = steps
+        assert id not in ALL_MACROS
+        ALL_MACROS[id] = self
+    def check(self, controlsfile):
+        super(Macro, self).check(controlsfile)
+        assert self.steps
+        if controlsfile is not None:
+            known = controlsfile.compact_ids()
+            for s in self.steps:
+                assert s == 'Pause' or s in known, 'Macro %s: unknown step %s' % (self.Name, s)
+    def __str__(self):
+        return 'Macro: %s %s'%(self.Name, self.steps)
+
 # a list of all menus, indexed by ID, so we can retrieve their contents efficiently
 ALL_MENUS = {} # indexed by id
 
@@ -307,7 +329,7 @@ class ControlsFile(XMLable):
         self.check(cf)
         rv = FILEHEADER%'ControlSystem' + '''<Capabilities>
     <Jog enabled="true"/>
-    <Shuttle enabled="false"/>
+    <Shuttle enabled="true"/>
     <StatusDisplay lineCount="3"/>
     <CustomControls enabled="true"/>
   </Capabilities>
@@ -355,6 +377,39 @@ class ControlsFile(XMLable):
             if c.id == id:
                 return c
         raise Exception('Control 0x%08x not found'%id)
+    def compact_ids(self):
+        """
+        Returns a dict mapping the MIDI2LR name of each action and parameter to its id.
+        These are the names which TangentBridge and the plugin may exchange by id (see lua_ids).
+        """
+        rv = {}
+        for g in self.groups:
+            for c in g.controls:
+                if isinstance(c, Macro):
+                    continue # not something MIDI2LR knows about
+                if isinstance(c, (Action, Parameter)) and c.id < 0x40000000: # not custom or reserved
+                    rv[c.Name] = c.id
+        return rv
+    def lua_ids(self):
+        """
+        Returns the source of a Lua module which maps control ids to MIDI2LR names (byId) and back (byName).
+        """
+        ids = self.compact_ids()
+        rv = LUAHEADER + 'local byId = {\n'
+        for name in sorted(ids, key=lambda n: ids[n]):
+            rv += TAB + "[0x%x] = '%s',\n" % (ids[name], name)
+        rv += '}\n'
+        rv += 'local byName = {}\n'
+        rv += 'for id, name in pairs(byId) do byName[name] = id end\n'
+        rv += 'return { byId = byId, byName = byName }\n'
+        return rv
+
+LUAHEADER = '''--[[----------------------------------------------------------------------------
+ControlIds.lua
+Tangent control ids for MIDI2LR names, used by the compact protocol with TangentBridge.
+Generated by TangentMappingDefinitions.py; do not edit.
+------------------------------------------------------------------------------]]
+'''
 
 
 ##################################################################33
@@ -503,6 +558,22 @@ class MapFile(XMLable):
         return rv
     def check(self, controlsfile):
         assert self.panels
+    def mode_keys(self, id):
+        """
+        Returns the keys (control ids) mapped to any control in the given mode, Std or Alt, in the order they appear.
+        """
+        rv = []
+        for p in self.panels:
+            for m in p.modes:
+                if m.id != id or not m.controlbanks:
+                    continue
+                for cb in m.controlbanks:
+                    for b in cb.banks:
+                        for c in b.controls:
+                            for mapping in (c.std, c.alt):
+                                if mapping is not None and mapping.key not in rv:
+                                    rv.append(mapping.key)
+        return rv
 
 if __name__ == '__main__':
     # This is test code.. for the real outputs, see TangentMappingDefinitions
@@ -211,6 +211,13 @@ controls = ControlsFile(
             Action(0x30c, 'openExportDialog', panel='Export...'),
             Action(0x30d, 'openExportWithPreviousDialog', panel='Export again', name9='ReExport'),
         ]),
+
+        Group('Macros', [
+            Macro(0x310, 'Pick, Next', ['Pick', 'Next'], name9='Pick+Next'),
+            Macro(0x311, 'Reject, Next', ['Reject', 'Next'], name9='Rej+Next'),
+            Macro(0x312, 'Auto Tone, Auto WB, Next', ['AutoTone', 'WhiteBalanceAuto', 'Pause', 'Next'],
+                panel='Auto All, Next', name9='Auto+Next'),
+        ]),
     ]
 )
 
@@ -1260,6 +1267,9 @@ elementmf.check(controls)
 elementkb.check(controls)
 elementbt.check(controls)
 
+# Every panel's map, for TangentBridge to find what each mode shows
+panel_maps = [wave, ripple, elementtk, elementmf, elementkb, elementbt]
+
 def write_file(filename, obj):
     if sys.version_info[0] < 3:
         # N.B. assumes latin_1 encoding; ASCII + some high-bit-set characters
@@ -1270,6 +1280,11 @@ def write_file(filename, obj):
             f.write( obj.xml(0, controls) )
     print("Wrote to %s"%filename)
 
+def write_lua(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+    print("Wrote to %s"%filename)
+
 
 if __name__ == '__main__':
     write_file('controls.xml', controls)
@@ -1279,3 +1294,4 @@ if __name__ == '__main__':
     write_file('element-mf-map.xml', elementmf)
     write_file('element-bt-map.xml', elementbt)
     write_file('element-kb-map.xml', elementkb)
+    write_lua('ControlIds.lua', controls.lua_ids())
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# Written to work on both Python 2 and 3
+
+# Scheduling of messages to Lightroom.
+#
+# A fast spin of an encoder produces dozens of updates a second for the same parameter,
+# and Lightroom has to apply each one in turn. Only the latest value matters, so we merge them.
+# Likewise a spin of the transport ring is a burst of steps, of which only the total matters.
+# And however they are merged, messages shouldn't go to Lightroom faster than it can apply them,
+# and a button press shouldn't wait behind a pile of routine traffic.
+
+import collections
+import time
+
+# time.monotonic is Python 3 only
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Default coalescing window, in seconds
+COALESCE_WINDOW = 0.03
+# Default window for collecting transport ring steps, in seconds
+JOG_WINDOW = 0.05
+# Default shuttle speed: photos a second for each unit the ring is turned off centre
+SHUTTLE_RATE = 2.0
+# Default time a parameter must be left alone for its gesture to end, in seconds
+GESTURE_IDLE = 0.5
+# Default round trip time to Lightroom that the rate controller aims to stay within, in seconds
+TARGET_LATENCY = 0.1
+# Bounds and starting point for the rate controller, in messages per second
+MIN_RATE = 10.0
+MAX_RATE = 2000.0
+INITIAL_RATE = 200.0
+# How far the rate rises for each timely round trip, and the factor it is cut by for a late one
+RATE_STEP = 2.0
+RATE_BACKOFF = 0.7
+# Messages which may go in a burst after a quiet spell
+RATE_BURST = 8
+# Messages a priority class may send in a row while a lower one waits
+STARVE_LIMIT = 8
+# Most parameters to have waiting to be read; beyond this the oldest are dropped
+READ_QUEUE_LIMIT = 64
+
+class Coalescer(object):
+    '''
+    Merges rapid updates to the same key (a parameter name).
+    The first update after a quiet spell is sent at once. Updates within the following window only replace
+    the value waiting to go; when the window closes, the latest value is sent and a new window opens.
+    So a parameter is sent at most once per window while it is moving, and its final value is always sent.
+    '''
+    def __init__(self, callLater, send, window=COALESCE_WINDOW):
+        # callLater(delay, fn, *args) schedules a callback, as Bridge.callLater; send(key, value) sends an update
+        self.callLater = callLater
+        self.send = send
+        self.window = window
+        self.pending = {} # key -> latest value, not yet sent
+        self.windows = {} # key -> timer for its open window
+        self.received = 0
+        self.sent = 0
+        self.merged = 0 # updates superseded before they were sent
+
+    def update(self, key, value):
+        self.received += 1
+        if key in self.windows:
+            if key in self.pending:
+                self.merged += 1
+            self.pending[key] = value
+            return
+        self.emit(key, value)
+        if self.window > 0:
+            self.windows[key] = self.callLater(self.window, self.close, key)
+
+    def close(self, key):
+        ''' Called when a key's window ends: sends its latest value, if it has changed since the window opened '''
+        del self.windows[key]
+        if key in self.pending:
+            self.emit(key, self.pending.pop(key))
+            self.windows[key] = self.callLater(self.window, self.close, key)
+
+    def discard(self, key):
+        ''' Forgets any value waiting to be sent for a key, e.g. because the parameter has been reset '''
+        self.pending.pop(key, None)
+
+    def flush(self):
+        ''' Sends every waiting value now '''
+        for key, t in list(self.windows.items()):
+            t.cancel()
+        self.windows = {}
+        pending, self.pending = self.pending, {}
+        for key, value in pending.items():
+            self.emit(key, value)
+
+    def emit(self, key, value):
+        self.sent += 1
+        self.send(key, value)
+
+    def stats(self):
+        return 'received %d, sent %d, merged %d' % (self.received, self.sent, self.merged)
+
+class Accumulator(object):
+    '''
+    Adds up steps (e.g. from the transport ring) for a short window from the first one, then sends the net total.
+    '''
+    def __init__(self, callLater, send, window=JOG_WINDOW):
+        # callLater as for Coalescer; send(total) is called with the net number of steps, which is never 0
+        self.callLater = callLater
+        self.send = send
+        self.window = window
+        self.total = 0
+        self.timer = None
+        self.received = 0 # steps, in either direction
+        self.sent = 0 # totals sent
+
+    def add(self, steps):
+        self.received += abs(steps)
+        self.total += steps
+        if self.window <= 0:
+            self.close()
+        elif self.timer is None:
+            self.timer = self.callLater(self.window, self.close)
+
+    def close(self):
+        self.timer = None
+        total, self.total = self.total, 0
+        if total:
+            self.sent += 1
+            self.send(total)
+
+    def stats(self):
+        return 'received %d steps, sent %d moves' % (self.received, self.sent)
+
+class Shuttle(object):
+    '''
+    Steps through photos while the shuttle ring is held off centre, at a rate proportional to the offset.
+    Only one step is outstanding at a time: until stepped() says Lightroom has done the last one, the next waits,
+    so the pace drops to whatever Lightroom can render rather than a backlog building up.
+    '''
+    def __init__(self, callLater, step, rate=SHUTTLE_RATE):
+        # callLater as for Coalescer; step(n) moves n (1 or -1) photos
+        self.callLater = callLater
+        self.step = step
+        self.rate = rate
+        self.offset = 0
+        self.timer = None
+        self.outstanding = False # a step has gone to Lightroom and not been done yet
+        self.due = False # the next step is due, but waiting for the outstanding one
+        self.steps = 0
+        self.late = 0 # steps which had to wait for Lightroom
+
+    def set(self, offset):
+        ''' The ring has moved to offset (0 is centre) '''
+        self.offset = offset if self.rate > 0 else 0
+        if self.offset == 0:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.due = False
+        elif self.timer is None and not self.due:
+            self.tick()
+
+    def tick(self):
+        self.timer = None
+        if self.offset == 0:
+            return
+        if self.outstanding:
+            self.due = True
+            self.late += 1
+            return
+        self.due = False
+        self.outstanding = True
+        self.steps += 1
+        self.step(1 if self.offset > 0 else -1)
+        self.timer = self.callLater(1.0 / (self.rate * abs(self.offset)), self.tick)
+
+    def stepped(self):
+        ''' Lightroom has done the outstanding step (or won't be telling us) '''
+        self.outstanding = False
+        if self.due:
+            self.tick()
+
+    def stats(self):
+        return '%d steps, %d waited for Lightroom' % (self.steps, self.late)
+
+class GestureTracker(object):
+    '''
+    Groups the updates to each key (a parameter name) into gestures: from the first update until there have
+    been none for the idle time. begin(key) is called as a gesture starts, before its first update is passed on;
+    end(key) when it has gone idle. If end(key) returns False the key isn't finished with yet (say, its last
+    value hasn't been sent), and it is checked again a little later.
+    '''
+    def __init__(self, callLater, begin, end, idle=GESTURE_IDLE, clock=monotonic):
+        self.callLater = callLater
+        self.begin = begin
+        self.end = end
+        self.idle = idle
+        self.clock = clock
+        self.last = {} # key -> time of its latest update, while its gesture is going
+        self.timers = {} # key -> timer to check whether it has gone idle
+        self.gestures = 0
+        self.updates = 0
+
+    def update(self, key):
+        if self.idle <= 0:
+            return
+        self.updates += 1
+        if key not in self.last:
+            self.gestures += 1
+            self.begin(key)
+            self.timers[key] = self.callLater(self.idle, self.check, key)
+        # Rather than reset the timer on every update, check when it fires and wait out the remainder
+        self.last[key] = self.clock()
+
+    def check(self, key):
+        quiet = self.clock() - self.last[key]
+        if quiet >= self.idle and self.end(key) is not False:
+            del self.last[key]
+            del self.timers[key]
+            return
+        self.timers[key] = self.callLater(max(self.idle - quiet, self.idle / 10), self.check, key)
+
+    def clear(self):
+        ''' Forgets every gesture without ending it, e.g. because Lightroom has gone away '''
+        for t in self.timers.values():
+            t.cancel()
+        self.last = {}
+        self.timers = {}
+
+    def stats(self):
+        return '%d updates in %d gestures' % (self.updates, self.gestures)
+
+class RateController(object):
+    '''
+    A token bucket whose rate follows Lightroom's measured round trip time.
+    Each message needs a token. While round trips come in within the target the rate creeps up;
+    when one is late the rate is cut back, at most once per round trip so one slow patch counts once.
+    A target of 0 turns rate control off.
+    '''
+    def __init__(self, target=TARGET_LATENCY, rate=INITIAL_RATE, minRate=MIN_RATE, maxRate=MAX_RATE,
+            burst=RATE_BURST, clock=monotonic):
+        self.target = target
+        self.rate = rate
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.filled = clock()
+        self.cutAt = 0 # when the rate was last cut
+        self.waits = 0 # times a message had to wait for a token
+        self.cuts = 0
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.filled) * self.rate)
+        self.filled = now
+
+    def take(self):
+        ''' Takes a token if there is one. Returns whether a message may go now. '''
+        if self.target <= 0:
+            return True
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.waits += 1
+        return False
+
+    def delay(self):
+        ''' Seconds until the next token '''
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def observe(self, rtt):
+        ''' Adjusts the rate for a measured round trip time '''
+        if self.target <= 0:
+            return
+        if rtt <= self.target:
+            self.rate = min(self.maxRate, self.rate + RATE_STEP)
+            return
+        now = self.clock()
+        if now - self.cutAt >= rtt:
+            self.cutAt = now
+            self.cuts += 1
+            self.rate = max(self.minRate, self.rate * RATE_BACKOFF)
+
+    def stats(self):
+        return 'rate %.0f/s, cut %d times, %d waits for a token' % (self.rate, self.cuts, self.waits)
+
+class PriorityScheduler(object):
+    '''
+    Chooses which of several queues (priority classes, highest first) to send from next.
+    The queues belong to the caller, who takes the messages off them; anything with a len() will do.
+    After STARVE_LIMIT messages in a row from higher classes while a lower class is waiting,
+    the lowest waiting class gets a turn, so nothing waits forever.
+    '''
+    def __init__(self, classes, starveLimit=STARVE_LIMIT):
+        # classes is a list of (name, queue)
+        self.names = [ name for name, _ in classes ]
+        self.queues = [ queue for _, queue in classes ]
+        self.starveLimit = starveLimit
+        self.passedOver = 0 # messages sent in a row while a lower class was waiting
+        self.sent = [0] * len(classes)
+        self.deepest = [0] * len(classes)
+        self.promoted = 0 # turns given to a starved class
+
+    def choose(self, held=()):
+        '''
+        Returns the index of the class to send from next, or None if they are all empty.
+        Classes in held are not to send for now.
+        '''
+        depths = [ len(q) for q in self.queues ]
+        for i, d in enumerate(depths):
+            if d > self.deepest[i]:
+                self.deepest[i] = d
+        waiting = [ i for i, d in enumerate(depths) if d and i not in held ]
+        if not waiting:
+            return None
+        if len(waiting) > 1 and self.passedOver >= self.starveLimit:
+            self.promoted += 1
+            return waiting[-1]
+        return waiting[0]
+
+    def served(self, i):
+        ''' Records that a message went from class i '''
+        self.sent[i] += 1
+        if any(len(q) for q in self.queues[i+1:]):
+            self.passedOver += 1
+        else:
+            self.passedOver = 0
+
+    def stats(self):
+        return [ '%s: sent %d, deepest %d' % (name, sent, deepest)
+                for name, sent, deepest in zip(self.names, self.sent, self.deepest) ] + [
+                'turns given to a starved class: %d' % self.promoted ]
+
+class ReadQueue(object):
+    '''
+    Parameters waiting to be read, in the order they were asked for, each with a tag (the mode it was asked in).
+    A parameter is only queued once; asking again just updates its tag.
+    If the queue is full the oldest read is dropped: the newest are for what the panel is showing now.
+    '''
+    def __init__(self, limit=READ_QUEUE_LIMIT):
+        self.limit = limit
+        self.reads = collections.OrderedDict() # name -> tag
+        self.queued = 0
+        self.duplicates = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.reads)
+
+    def add(self, name, tag):
+        if name in self.reads:
+            self.duplicates += 1
+        else:
+            self.queued += 1
+            if len(self.reads) >= self.limit:
+                self.reads.popitem(last=False)
+                self.dropped += 1
+        self.reads[name] = tag
+
+    def popleft(self):
+        ''' Takes the oldest read. Returns (name, tag). '''
+        return self.reads.popitem(last=False)
+
+    def drop(self, test):
+        ''' Removes the reads for which test(name, tag) is true. Returns how many. '''
+        stale = [ name for name, tag in self.reads.items() if test(name, tag) ]
+        for name in stale:
+            del self.reads[name]
+        return len(stale)
+
+    def clear(self):
+        self.reads.clear()
+
+    def stats(self):
+        return 'queued %d, already waiting %d, dropped %d' % (self.queued, self.duplicates, self.dropped)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Written to work on both Python 2 and 3
+
+# Transports connect the bridge's three links (Tangent, LR send, LR receive) to something.
+# A transport provides:
+#   connect(links)  - links is a list of (name, port); returns a dict mapping each name
+#                     to a connected non-blocking socket-like object, or the socket.error from trying
+#   wait(rlist, wlist, timeout) - like select(), returns (readable, writable)
+#
+# TcpTransport is the real thing: TCP connections to the Tangent Hub and the Lightroom plugin.
+# SocketPairTransport and MemoryTransport connect each link to a stand-in in the same process,
+# available as transport.peers[name], so the bridge can be driven and measured without live endpoints.
+# (The asyncio engine needs real sockets, so it works with the first two only.)
+
+import errno
+import os
+import select
+import socket
+import time
+
+# time.monotonic is Python 3 only
+monotonic = getattr(time, 'monotonic', time.time)
+
+CONNECT_TIMEOUT = 2.0 # seconds
+
+def nodelay(sock):
+    # Our messages are small and latency-sensitive; don't let Nagle hold them back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class TcpTransport(object):
+    def __init__(self, address='127.0.0.1', timeout=CONNECT_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+
+    def connect(self, links):
+        ''' Connects to all the links' ports in parallel '''
+        results = {}
+        pending = {}
+        for name, port in links:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex((self.address,port))
+            if err == 0:
+                results[name] = sock
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                pending[sock] = name
+            else:
+                sock.close()
+                results[name] = socket.error(err, os.strerror(err))
+        deadline = monotonic() + self.timeout
+        while pending:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            # Windows reports failed connects as exceptional; everyone else as writable
+            _,wlist,xlist = select.select([], list(pending), list(pending), remaining)
+            for sock in set(wlist + xlist):
+                name = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    sock.close()
+                    results[name] = socket.error(err, os.strerror(err))
+                else:
+                    results[name] = sock
+        for sock, name in pending.items():
+            sock.close()
+            results[name] = socket.timeout('timed out')
+        for r in results.values():
+            if not isinstance(r, socket.error):
+                nodelay(r)
+        return results
+
+    def wait(self, rlist, wlist, timeout):
+        rlist,wlist,_ = select.select(rlist, wlist, [], timeout)
+        return rlist, wlist
+
+class SocketPairTransport(TcpTransport):
+    ''' Connects each link to one end of a socketpair. The other ends are in self.peers. '''
+    def __init__(self):
+        super(SocketPairTransport, self).__init__()
+        self.peers = {}
+
+    def connect(self, links):
+        results = {}
+        for name, _ in links:
+            ours, theirs = socket.socketpair()
+            ours.setblocking(False)
+            self.peers[name] = theirs
+            results[name] = ours
+        return results
+
+class MemoryEndpoint(object):
+    '''
+    One end of an in-memory connection, with enough of the socket API for the bridge (and a test harness).
+    It never blocks: reads with nothing waiting raise EAGAIN, as on a non-blocking socket.
+    '''
+    def __init__(self):
+        self.inbox = bytearray()
+        self.peer = None
+        self.closed = False
+
+    @staticmethod
+    def pair():
+        a, b = MemoryEndpoint(), MemoryEndpoint()
+        a.peer, b.peer = b, a
+        return a, b
+
+    def readable(self):
+        return bool(self.inbox) or self.peer.closed
+
+    def recv_into(self, buf, nbytes=0):
+        n = min(nbytes or len(buf), len(self.inbox))
+        if n == 0:
+            if self.peer.closed:
+                return 0
+            raise socket.error(errno.EAGAIN, 'no data')
+        buf[0:n] = self.inbox[0:n]
+        del self.inbox[0:n]
+        return n
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        n = self.recv_into(buf)
+        return bytes(buf[0:n])
+
+    def send(self, data):
+        if self.closed or self.peer.closed:
+            raise socket.error(errno.EPIPE, 'closed')
+        self.peer.inbox.extend(data)
+        return len(data)
+
+    def sendmsg(self, chunks):
+        n = 0
+        for c in chunks:
+            n += self.send(c)
+        return n
+
+    def sendall(self, data):
+        self.send(data)
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class MemoryTransport(object):
+    ''' Connects each link to an in-memory endpoint. The other ends are in self.peers. '''
+    def __init__(self):
+        self.peers = {}
+
+    def connect(self, links):
+        results = {}
+        for name, _ in links:
+            ours, theirs = MemoryEndpoint.pair()
+            self.peers[name] = theirs
+            results[name] = ours
+        return results
+
+    def wait(self, rlist, wlist, timeout):
+        # Memory endpoints can always be written to
+        rlist = [ e for e in rlist if e.readable() ]
+        if not rlist and not wlist and timeout:
+            time.sleep(timeout)
+        return rlist, list(wlist)
+
+if __name__ == '__main__':
+    # Throughput benchmark: drives the bridge's protocol logic in-process, without kernel networking.
+    import struct
+    import sys
+    from TangentBridge import Bridge
+
+    def frame(*words):
+        body = b''.join(words)
+        return struct.pack('>i', len(body)) + body
+
+    transport = MemoryTransport()
+    bridge = Bridge(sys.argv[0], transport=transport)
+    bridge.log = lambda msg: None
+    hub, lrsend, lrrecv = transport.peers['Tangent'], transport.peers['LRSend'], transport.peers['LRRecv']
+    hub.sendall(frame(struct.pack('>iii', 1, 5, 1))) # Initiate Comms
+    bridge.runOnce(0)
+
+    N = 100000
+    turn = frame(struct.pack('>iif', 2, 0x203, 0.0001)) # Exposure
+    start = monotonic()
+    for i in range(N):
+        hub.sendall(turn)
+        bridge.runOnce(0)
+        # Acknowledge, as the plugin does
+        lrsend.sendall(b'ok' * lrsend.inbox.count(b'\n'))
+        lrsend.inbox = bytearray()
+    elapsed = monotonic() - start
+    print('Encoder turns: %d in %.3fs, %.0f/s' % (N, elapsed, N/elapsed))
+
+    update = b'Exposure 0.5\n'
+    start = monotonic()
+    for i in range(N):
+        lrrecv.sendall(update)
+        bridge.runOnce(0)
+        hub.inbox = bytearray()
+    elapsed = monotonic() - start
+    print('LR updates: %d in %.3fs, %.0f/s' % (N, elapsed, N/elapsed))